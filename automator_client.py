@@ -1,150 +1,24 @@
 from __future__ import print_function
 
 import os
+import json
 import time
 import curses
 import argparse
 import Pyro4
 
-def get_fields(w, idx):
-    value_names = w['experiment']['watch']
-    values = w['state']['watched_values']
+from monitor import display_info, WorkersMirror
+from federation import Federation, FederatedMirror, DEFAULT_TIMEOUT
 
-    ds = []
-
-    num_values = len(value_names)
-
-    for line_idx in xrange(max(num_values, 1)):
-        if num_values == 0:
-            value_name = ''
-            value = ''
-        else:
-            value_name = value_names[line_idx]
-            value = str(values[line_idx])
-
-        d = {
-            'idx': '',
-            'status': '',
-            'path': '',
-            'desc': '',
-            'progress': '',
-            'value_name': value_name,
-            'value': value
-        }
-
-        if line_idx > 0:
-            ds.append(d)
-            continue
-
-        iteration = int(w['state']['iter'])
-        max_iteration = int(w['state']['max_iter'])
-
-        status = w['state']['status']
-        if status == 0:
-            status = 'WAITING'
-        elif status == 1:
-            status = 'RUNNING'
-        else:
-            status = 'FINISHED'
-
-        d.update({
-            'idx': str(idx),
-            'status': status,
-            'path': w['experiment']['path'],
-            'desc': w['experiment']['description'],
-            'progress': '{:d} / {:d}'.format(iteration, max_iteration)
-        })
-
-        ds.append(d)
-
-    return ds
-
-def display_info(stdscr, automator_server, interval):
-    curses.curs_set(0)
-    curses.start_color()
-
-    curses.init_pair(1, curses.COLOR_BLUE, curses.COLOR_BLACK)
-
-    height, width = stdscr.getmaxyx()
-
-    if interval < 0:
-        interval = 0
-
-    if interval == 0:
-        stdscr.timeout(-1)
-    else:
-        stdscr.timeout(interval * 1000)
-
-    header = {
-        'idx': 'ID',
-        'status': 'STATUS',
-        'path': 'PATH',
-        'desc': 'DESCRIPTION',
-        'progress': 'ITER / MAX_ITER',
-        'value_name': 'NAME',
-        'value': 'VALUE'
-    }
-
-    fields_order = ['idx', 'status', 'path', 'desc', 'progress', 'value_name', 'value']
-    
-    format_s = []
-    for k in fields_order:
-        format_s.append('{{{}:<{{{}}}}}'.format(k, k + '_width'))
-    format_s = '  '.join(format_s)
-
-    while True:
-        stdscr.clear()
-        stdscr.border()
-
-        stdscr.addstr(1, 2, 'List of running experiments:')
-
-        workers_info = automator_server.get_workers_info()
-
-        # Get all data as strings.
-        entries = []
-        for i, w in enumerate(workers_info):
-            entries.append(get_fields(w, i))
-
-        # Calculate widths.
-        widths = {}
-        for k, v in header.items():
-            widths[k] = len(v)
-        for e in entries:
-            for l in e:
-                for k, v in l.items():
-                    widths[k] = max(widths[k], len(v))
-
-        widths = dict(zip([k + '_width' for k in widths.keys()], widths.values()))
-
-        # for k in widths.keys():
-        #     widths[k] = widths.keys() + 1
-
-        # Output data
-        header_format_d = {}
-        header_format_d.update(header)
-        header_format_d.update(widths)
-        s = format_s.format(**header_format_d)      
-        stdscr.addstr(3, 2, s, curses.A_BOLD)
-
-        line_idx = 4
-        for i, e in enumerate(entries):
-            for l in e:
-                l.update(widths)
-                s = format_s.format(**l)  
-                stdscr.addstr(line_idx, 2, s, curses.color_pair(i % 2))
-                line_idx += 1
-
-        stdscr.refresh()
-
-        if interval == 0:
-            break
-
-        c = stdscr.getch()
-        if c != -1:
-            break
-
-    if interval == 0: 
-        stdscr.getch()
+def parse_range(s):
+    """
+    Parses an index range given as start:stop, either of which may be left
+    out, or as a single index.
+    """
+    if ':' not in s:
+        return int(s), int(s) + 1
+    start, stop = s.split(':', 1)
+    return (int(start) if start else None), (int(stop) if stop else None)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Client for the automator.')
@@ -155,20 +29,52 @@ if __name__ == '__main__':
     parser.add_argument('-i', '--interval', type=int, default=0)
     parser.add_argument('-k', '--kill', type=int, default=-1)
     parser.add_argument('-a', '--kill-all', action='store_true', default=False)
+    parser.add_argument('-K', '--kill-many', action='store_true', default=False,
+                        help='stop the experiments matching --status, '
+                             '--path and --range')
+    parser.add_argument('-P', '--pause', action='store_true', default=False,
+                        help='pause the matching running experiments')
+    parser.add_argument('-R', '--resume', action='store_true', default=False,
+                        help='resume the matching paused experiments')
+    parser.add_argument('--status', default=None,
+                        help='comma-separated statuses to match, e.g. '
+                             'WAITING,RUNNING')
+    parser.add_argument('--path', default=None,
+                        help='glob the experiment paths have to match')
+    parser.add_argument('--range', default='',
+                        help='index range start:stop of the --list order '
+                             'to match')
+    parser.add_argument('--grace', type=float, default=None,
+                        help='seconds training processes get to exit on '
+                             'SIGTERM before SIGKILL (default: that of the '
+                             'server)')
     parser.add_argument('-p', '--port', type=int, default=-1)
     parser.add_argument('-t', '--terminate-server', action='store_true', default=False)
+    parser.add_argument('-b', '--leaderboard', default='')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('-s', '--stats', action='store_true', default=False)
+    parser.add_argument('-S', '--servers', default='',
+                        help='comma-separated host:port or Pyro URIs of '
+                             'several servers to use together')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='seconds to wait for every server when using '
+                             'several (default: %g)' % DEFAULT_TIMEOUT)
 
     args = parser.parse_args()
 
-    tmp_dir = os.path.expanduser('~/.automator')
-    if not os.path.exists(tmp_dir):
-        if args.port < 0:
-            raise RuntimeError('Unable to locate server. Please specify port.')
-        uri = 'PYRO:automator_server@localhost:%d' % args.port
+    if args.servers:
+        automator_server = Federation(args.servers.split(','), args.timeout)
     else:
-        uri = file(os.path.join(tmp_dir, 'uri'), 'r').read()
+        tmp_dir = os.path.expanduser('~/.automator')
+        if not os.path.exists(tmp_dir):
+            if args.port < 0:
+                raise RuntimeError(
+                    'Unable to locate server. Please specify port.')
+            uri = 'PYRO:automator_server@localhost:%d' % args.port
+        else:
+            uri = file(os.path.join(tmp_dir, 'uri'), 'r').read()
 
-    automator_server = Pyro4.Proxy(uri)
+        automator_server = Pyro4.Proxy(uri)
 
     if args.experiments:
         experiments_path = os.path.abspath(os.path.expanduser(args.experiments))
@@ -177,13 +83,44 @@ if __name__ == '__main__':
             experiments_path, args.replace, args.no_run)
 
     if args.list:
-        curses.wrapper(display_info, automator_server, args.interval)
+        if args.servers:
+            mirror = FederatedMirror(automator_server)
+        else:
+            mirror = WorkersMirror(automator_server)
+        curses.wrapper(display_info, mirror, args.interval)
+
+    if args.leaderboard:
+        rows = automator_server.get_leaderboard(args.leaderboard, args.top)
+        for rank, row in enumerate(rows):
+            print('{:>4}  {:<48}  {:g}'.format(
+                rank + 1, row['path'], row[args.leaderboard]))
+
+    if args.stats:
+        print(json.dumps(automator_server.get_stats(), indent=2,
+                         sort_keys=True))
 
     if args.kill >= 0:
         automator_server.kill(args.kill)
 
+    if args.kill_many or args.pause or args.resume:
+        status = args.status.split(',') if args.status else None
+        start, stop = parse_range(args.range) if args.range else (None, None)
+
+        if args.kill_many:
+            for path in automator_server.kill_many(status, args.path, start,
+                                                   stop, args.grace):
+                print('[*] Stopped %s.' % path)
+        if args.pause:
+            for path in automator_server.pause(status, args.path, start,
+                                               stop):
+                print('[*] Paused %s.' % path)
+        if args.resume:
+            for path in automator_server.resume(status, args.path, start,
+                                                stop):
+                print('[*] Resumed %s.' % path)
+
     if args.kill_all:
-        automator_server.kill_all()
+        automator_server.kill_all(args.grace)
 
     if args.terminate_server:
         automator_server.terminate()      
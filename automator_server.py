@@ -1,97 +1,1140 @@
 from __future__ import print_function
 
 import os
+import time
+import signal
+import fnmatch
 import argparse
-import yaml
+import threading
+import itertools
+import functools
+import Queue
+from collections import deque, OrderedDict
 import Pyro4
-from multiprocessing import Semaphore
+import multiprocessing as mp
 
 import util
+import stats
 import preprocessing
-from worker import Worker
+from worker import (Worker, waiting_state, render_protos, make_hash,
+                    materialize_all,
+                    find_training_process, KILL_GRACE,
+                    KILL_TIMEOUT)
+from supervisor import Supervisor, Job
+from scheduler import DeviceScheduler
+from halving import HalvingController
+from results import (CompletedIndex, ResultsDB, is_completed, make_result,
+                     HALTED)
+from metrics_store import MetricsReader
+from query import ExperimentIndex, status_code
+from journal import Journal
 
-def freeze(o):
-  if isinstance(o, dict):
-    return frozenset({k: freeze(v) for k, v in o.items()}.items())
-  if isinstance(o, list):
-    return tuple([freeze(v) for v in o])
-  return o
+DISPATCH_INTERVAL = 5
+# Put into the done queue to make the dispatcher return.
+STOP_DISPATCH = -1
+HALVING_INTERVAL = 5
+BRANCH_INTERVAL = 5
+# Removals remembered for get_changes(); clients lagging further behind get
+# everything anew.
+MAX_REMOVALS = 10000
+RESULTS_INTERVAL = 5
+# Finished experiments kept in the listing.
+MAX_FINISHED = 1000
+STATS_INTERVAL = 10
 
-def make_hash(o):
+class PendingExperiment(object):
     """
-    Makes a hash out of anything that contains only list,dict and hashable types including string and numeric types
+    An experiment queued for a free slot. Only the experiment dict is kept
+    around; the Worker is created once the experiment gets to run.
     """
-    return hash(freeze(o))  
+    def __init__(self, root_path, experiment):
+        self.root_path = root_path
+        self.experiment = experiment
+        self.is_cancelled = False
+
+    def get_state(self):
+        return waiting_state(self.experiment)
+
+    def get_version(self):
+        return 0
+
+    def get_stats(self):
+        return None
+
+    def get_history(self, value_name=None, start=0, stop=None):
+        return {}
+
+    def get_metrics(self, names=None, start=0, stop=None):
+        return {}
+
+    def set_paused(self, paused):
+        return False
+
+    def shutdown(self, grace=None):
+        self.is_cancelled = True
+
+    def is_alive(self):
+        return not self.is_cancelled
+
+    def join(self, timeout=None):
+        pass
+
+class UnexpandedPoint(PendingExperiment):
+    """
+    Placeholder of a sweep point that its source has not drawn yet. It is
+    listed as waiting and can be cancelled, but it is neither rendered nor
+    deduplicated before it is drawn, so it may still turn out to be known
+    or completed.
+    """
+    def __init__(self, source, index, root_path, experiment):
+        PendingExperiment.__init__(self, root_path, experiment)
+        self.source = source
+        self.index = index
+
+    def shutdown(self, grace=None):
+        self.source.cancel([self])
+
+    def is_alive(self):
+        return (self.index >= self.source.drawn and
+                self.index not in self.source.cancelled)
+
+class SweepSource(object):
+    """
+    The points of a sweep that are still to be queued, drawn one at a time
+    as the scheduler needs them (see `DeviceScheduler.push_source`). The
+    points left are listed as `UnexpandedPoint` placeholders, which are
+    made the first time they are asked for.
+    """
+    ids = itertools.count()
+
+    def __init__(self, root_path, unroll, count, draw):
+        """
+        `unroll` returns a new iterator over the `count` points. `draw`
+        turns a point into a queue item, or returns None to skip it.
+        """
+        self.id = next(self.ids)
+        self.root_path = root_path
+        self.unroll = unroll
+        self.points = unroll()
+        self.count = count
+        self.draw = draw
+        # Points taken from `points` so far, and the indices of the ones
+        # after them that are cancelled.
+        self.drawn = 0
+        self.cancelled = set()
+        self.placeholders = None
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return max(self.count - self.drawn - len(self.cancelled), 0)
+
+    def next(self):
+        for e in self.points:
+            index = self.drawn
+            self.drawn += 1
+            if self.placeholders:
+                self.placeholders.popleft()
+            if index in self.cancelled:
+                self.cancelled.discard(index)
+                continue
+
+            item = self.draw(e)
+            if item is not None:
+                return item
+        raise StopIteration
+
+    def pending(self):
+        """
+        Placeholders of the points left that are not cancelled. Points that
+        are not hashed yet are listed under a key of their own instead.
+        """
+        if self.placeholders is None:
+            self.placeholders = deque()
+            points = itertools.islice(self.unroll(), self.drawn, None)
+            for index, e in enumerate(points, self.drawn):
+                if 'hash' not in e:
+                    e['hash'] = 'unexpanded:%d:%d' % (self.id, index)
+                self.placeholders.append(
+                    UnexpandedPoint(self, index, self.root_path, e))
+        return [p for p in self.placeholders
+                if p.index not in self.cancelled]
+
+    def cancel(self, placeholders):
+        """
+        Keeps the points of the given placeholders from being drawn.
+        """
+        self.cancelled.update(p.index for p in placeholders
+                              if p.index >= self.drawn)
+
+class FinishedExperiment(object):
+    """
+    What is left of an experiment after it is done: its final state, kept
+    in the listing and restored from the results database on restart, and
+    the value history it ended with, unless it was restored.
+    """
+    def __init__(self, root_path, experiment, state, history=None):
+        self.root_path = root_path
+        self.experiment = experiment
+        self.state = state
+        self.history = history
+
+    def get_state(self):
+        return dict(self.state)
+
+    def get_version(self):
+        return self.state['version']
+
+    def get_stats(self):
+        return None
+
+    def get_history(self, value_name=None, start=0, stop=None):
+        if self.history is None:
+            return {}
+        if value_name is None:
+            names = self.history.names
+        else:
+            names = [value_name]
+        # Nothing writes to the buffers any more.
+        return dict((name, self.history.get(name, start, stop))
+                    for name in names)
+
+    def get_metrics(self, names=None, start=0, stop=None):
+        metrics_path = os.path.join(self.root_path, self.experiment['path'],
+                                    'logs', 'metrics')
+        return MetricsReader(metrics_path).read_all(names, start, stop)
+
+    def set_paused(self, paused):
+        return False
+
+    def shutdown(self, grace=None):
+        pass
+
+    def is_alive(self):
+        return False
+
+    def join(self, timeout=None):
+        pass
 
 class AutomatorServer(object):
-    def __init__(self, caffe_root, limit, pyro_daemon):
+    def __init__(self, caffe_root, limit, pyro_daemon, engine='process',
+                 devices=None, results_path=None, journal_path=None,
+                 instrument=False, stats_path=None, kill_grace=KILL_GRACE):
+        """
+        With `instrument`, the server and its workers keep counters and
+        timings for `get_stats`. They are written to `stats_path` in the
+        Prometheus text format as well, if given. Training processes that
+        are stopped get `kill_grace` seconds after SIGTERM before SIGKILL.
+        """
+        if instrument or stats_path:
+            stats.enable()
+
         self.pyro_daemon = pyro_daemon
         self.caffe_root = caffe_root
+        self.kill_grace = kill_grace
         self.workers = []
-        if limit <= 0:
-            self.limit_sem = None
-        else:
+        self.lock = threading.RLock()
+        # Hashes of the experiments that are queued, running or drawn from
+        # a sweep, for deduplication.
+        self.hashes = set()
+        # Completed experiments per root path, loaded on first use.
+        self.completed = {}
+        # Points of branching sweeps held back until their trunk is done:
+        # trunk hash -> [root path, trunk path, points, priority, request].
+        self.held = {}
+        self.branching = False
+
+        # Change tracking for get_changes() and query(). Entries are
+        # identified by their experiment hash and map to [entry, entry
+        # version, sequence number of the last change, sequence number of
+        # the addition, state].
+        self.change_seq = 0
+        self.tracked = {}
+        self.index = ExperimentIndex()
+        self.order = []
+        self.order_seq = 0
+        self.removals = deque()
+        self.removals_floor = 0
+
+        # hash -> (time, lines parsed) as of the last get_stats().
+        self.stats_samples = {}
+        self.stats_path = stats_path
+
+        # Finished experiments shown after the live ones, most recent last.
+        self.finished = OrderedDict()
+        self.results = None
+        if results_path:
+            self.results = ResultsDB(results_path)
+            for root_path, experiment, state in self.results.recent(
+                    MAX_FINISHED):
+                self.finished[experiment['hash']] = FinishedExperiment(
+                    root_path, experiment, state)
+
+        if limit > 0:
             print('[*] Simultaneous experiments limit set to %d.' % limit)
-            self.limit_sem = Semaphore(limit)
+        if devices:
+            print('[*] Scheduling over devices: %s.' % ', '.join(devices))
+        self.scheduler = DeviceScheduler(devices, limit)
+        self.halving = None
+        # Hashes of the experiments halving stopped, until they are done.
+        self.halted = set()
+
+        self.journal = None
+        if journal_path:
+            self.journal = Journal(journal_path)
+
+        if engine == 'supervisor':
+            self.supervisor = Supervisor(self.scheduler, journal=self.journal)
+        else:
+            self.supervisor = None
+
+            # Devices held by running workers, keyed by worker slot.
+            self.allocations = {}
+            self.slots = itertools.count()
+            self.done_queue = mp.Queue()
+
+        if self.journal is not None:
+            self.reattach()
+
+        if self.supervisor:
+            self.supervisor.start()
+        else:
+            self.dispatcher = threading.Thread(target=self.dispatch_loop)
+            self.dispatcher.daemon = True
+            self.dispatcher.start()
+
+        if self.results is not None:
+            results_thread = threading.Thread(target=self.results_loop)
+            results_thread.daemon = True
+            results_thread.start()
+
+        if self.stats_path:
+            stats_thread = threading.Thread(target=self.stats_loop)
+            stats_thread.daemon = True
+            stats_thread.start()
+
+    def reattach(self):
+        """
+        Takes over the training processes that were launched before a
+        restart and are still running, instead of launching them again.
+        """
+        for h, record in self.journal.records.items():
+            root_path = record['root_path']
+            experiment = record['experiment']
+            process = find_training_process(root_path, experiment)
+            if process is None:
+                self.journal.done(h)
+                continue
+
+            print('[*] Reattaching to %s (pid %d).' % (experiment['path'],
+                                                       process['pid']))
+            # Nobody would resume it if the last server had paused it.
+            util.signal_group(process['pgid'], signal.SIGCONT)
+            request = record['request']
+            devices = self.scheduler.reserve(record['devices'], request)
+            self.hashes.add(h)
+
+            if self.supervisor:
+                self.supervisor.attach(root_path, experiment, devices,
+                                       request, process)
+            else:
+                w = Worker(root_path, experiment, devices, self.done_queue,
+                           next(self.slots), attach=process)
+                self.allocations[w.slot] = (devices, request)
+                self.workers.append(w)
+                w.start()
+
+    def dispatch_loop(self):
+        """
+        Turns pending experiments into workers as devices become free, until
+        the server terminates.
+        """
+        while True:
+            self.dispatch()
+            try:
+                slot = self.done_queue.get(timeout=DISPATCH_INTERVAL)
+            except Queue.Empty:
+                continue
+            if slot == STOP_DISPATCH:
+                return
+            with self.lock:
+                self.release(slot)
+
+    def dispatch(self):
+        with self.lock:
+            for w in self.workers:
+                if not w.is_alive():
+                    self.reap(w)
+
+            for p, devices, request in self.scheduler.pop_ready():
+                w = Worker(p.root_path, p.experiment, devices,
+                           self.done_queue, next(self.slots))
+                self.allocations[w.slot] = (devices, request)
+                self.workers.append(w)
+                w.start()
+                if self.journal is not None:
+                    self.journal.launched(p.root_path, p.experiment, devices,
+                                          request)
 
+    def reap(self, w):
+        """
+        Releases the devices of a worker that is gone, in case it died
+        without reporting back, e.g. to SIGKILL or the OOM killer. Its
+        training process is killed then, since it would go on using them.
+        """
+        if w.slot not in self.allocations:
+            return
+        pgid = w.state['pgid'].value
+        if w.exitcode != 0 and pgid > 0:
+            print('[!] Worker of %s died, killing its training process.' %
+                  w.experiment['path'])
+            util.signal_group(pgid, signal.SIGKILL)
+        self.release(w.slot)
+
+    def release(self, slot):
+        allocation = self.allocations.pop(slot, None)
+        if allocation is not None:
+            self.scheduler.release(*allocation)
+
+    def entries(self):
+        """
+        Running workers followed by the experiments still queued.
+        """
+        if self.supervisor:
+            return self.supervisor.entries()
+        with self.lock:
+            return self.workers + self.scheduler.queued()
+
+    def get_completed_index(self, root_path):
+        root_path = os.path.abspath(root_path)
+        index = self.completed.get(root_path)
+        if index is None:
+            index = CompletedIndex(root_path)
+            self.completed[root_path] = index
+        return index
+
+    def admit(self, root_path, e, no_run, replace_mode, completed):
+        """
+        Hashes an unrolled experiment. Returns False for one that is
+        already known or, unless everything is to be replaced, already
+        completed. Sweeps are drawn under the scheduler's lock, which is
+        the supervisor's one in that engine, so the server lock must not
+        be taken here. Points that cannot be rendered are skipped, since
+        by the time the later ones are drawn there is no caller to report
+        to.
+        """
+        e['caffe_root'] = self.caffe_root
+        try:
+            h = make_hash(root_path, e)
+        except (KeyError, ValueError, EnvironmentError) as error:
+            print('[!] Skipping %s: %r' % (e['path'], error))
+            return False
+        e['hash'] = h
+        e['no_run'] = no_run
+        e['replace_mode'] = replace_mode
+
+        if h in self.hashes:
+            return False
+        if h in completed and replace_mode != 2:
+            return False
+        self.hashes.add(h)
+        return True
+
+    def iter_points(self, root_path, points, no_run, replace_mode):
+        """
+        Goes lazily through unrolled experiments, skipping the ones that
+        `admit` does not let through.
+        """
+        completed = self.get_completed_index(root_path)
+        for e in points:
+            if self.admit(root_path, e, no_run, replace_mode, completed):
+                yield e
+
+    @stats.timed
     def push_experiments(self, path, replace_mode=0, no_run=False):
-        data = yaml.load(file(path, 'r'))
-        root_path = data['root_path']
-        experiments = preprocessing.preprocess_experiments(data)
-
-        # Inject additional fields.
-        for e in experiments:
-            e['caffe_root'] = self.caffe_root
-            h = make_hash({'model': e['model'], 'solver': e['solver']})
-            e['hash'] = h
-            e['no_run'] = no_run
-            e['replace_mode'] = replace_mode
+        root_path, sweeps = preprocessing.load_sweeps(path)
 
         self.cleanup()
 
-        existing_hashes = [w.experiment['hash'] for w in self.workers]
-        
-        for e in experiments:
-            if e['hash'] in existing_hashes:
-                continue
-            self.workers.append(Worker(root_path, e, self.limit_sem))
-            self.workers[-1].start()
+        if no_run:
+            self.prepare_experiments(
+                root_path, (e for sweep in sweeps
+                            for e in preprocessing.iter_unrolled(sweep)),
+                replace_mode)
+            return
+
+        # Later points are rendered as they come up in the queue, but a
+        # template that does not fit a sweep at all is reported here.
+        for sweep in sweeps:
+            for e in itertools.islice(preprocessing.iter_unrolled(sweep), 1):
+                render_protos(root_path, e)
+
+        with self.lock:
+            for sweep in sweeps:
+                if sweep['branch']['at'] > 0:
+                    points = self.iter_points(
+                        root_path, preprocessing.iter_unrolled(sweep), no_run,
+                        replace_mode)
+                    self.push_branches(root_path, points, sweep['priority'],
+                                       sweep['gpus'], replace_mode)
+                else:
+                    self.queue_sweep(root_path, sweep, replace_mode)
+
+            if any('halving' in e for e in sweeps):
+                self.start_halving()
+            if any(e['branch']['at'] > 0 for e in sweeps):
+                self.start_branching()
+
+        if not self.supervisor:
+            # Wake up the dispatcher.
+            self.done_queue.put(None)
+
+    @stats.timed
+    def push_experiment_list(self, root_path, experiments, replace_mode=0,
+                             no_run=False):
+        """
+        Queues experiments that are unrolled already, e.g. the share of a
+        sweep that a coordinator sent (see federation.py). Known and
+        completed ones are skipped as by `push_experiments`. Returns the
+        number of experiments queued.
+        """
+        self.cleanup()
+
+        if no_run:
+            return self.prepare_experiments(root_path, experiments,
+                                            replace_mode)
+
+        with self.lock:
+            points = list(self.iter_points(root_path, experiments, no_run,
+                                           replace_mode))
+            # (priority, request) -> points of branching sweeps
+            branching = OrderedDict()
+            for e in points:
+                if e['branch']['at'] > 0:
+                    branching.setdefault((e['priority'], e['gpus']),
+                                         []).append(e)
+                elif self.supervisor:
+                    self.supervisor.submit(root_path, e)
+                else:
+                    self.scheduler.push(PendingExperiment(root_path, e),
+                                        e['priority'], e['gpus'])
+            for (priority, request), branches in branching.items():
+                self.push_branches(root_path, branches, priority, request,
+                                   replace_mode)
+
+            if any('halving' in e for e in points):
+                self.start_halving()
+            if branching:
+                self.start_branching()
+
+        if not self.supervisor:
+            self.done_queue.put(None)
+        return len(points)
+
+    def queue_sweep(self, root_path, sweep, replace_mode):
+        """
+        Queues the points of a sweep lazily: they are unrolled, hashed and
+        deduplicated as they come up in the queue.
+        """
+        completed = self.get_completed_index(root_path)
 
+        def admit(e):
+            return self.admit(root_path, e, False, replace_mode, completed)
+
+        self.queue_source(root_path,
+                          functools.partial(preprocessing.iter_unrolled,
+                                            sweep),
+                          preprocessing.count_unrolled(sweep),
+                          sweep['priority'], sweep['gpus'], admit)
+
+    def queue_points(self, root_path, points, priority, request):
+        """
+        Queues a list of points that are hashed and deduplicated already,
+        e.g. the branches of a trunk.
+        """
+        self.queue_source(root_path, points.__iter__, len(points), priority,
+                          request, lambda e: True)
+
+    def queue_source(self, root_path, unroll, count, priority, request,
+                     admit):
+        """
+        Queues the points `unroll` goes through (see `SweepSource`) as the
+        queue items of the engine, skipping the ones `admit` rejects.
+        """
+        if self.supervisor:
+            make = functools.partial(Job, self.supervisor, root_path)
+        else:
+            make = functools.partial(PendingExperiment, root_path)
+
+        def draw(e):
+            if admit(e):
+                return make(e)
+            return None
+
+        source = SweepSource(root_path, unroll, count, draw)
+        if self.supervisor:
+            self.supervisor.submit_source(source, priority, request)
+        else:
+            self.scheduler.push_source(source, priority, request)
+
+    def push_branches(self, root_path, points, priority, request,
+                      replace_mode):
+        """
+        Queues the trunks of a branching sweep and holds its points back
+        until their trunk has completed; they resume from its last
+        snapshot then. Points whose trunk has completed before are queued
+        right away.
+        """
+        trunks = OrderedDict()
+        for e in points:
+            trunk = preprocessing.make_trunk(e)
+            e['warm_start'] = trunk['path']
+            trunks.setdefault(trunk['path'], (trunk, []))[1].append(e)
+
+        completed = self.get_completed_index(root_path)
+        for trunk, branches in trunks.values():
+            h = make_hash(root_path, trunk)
+            trunk['hash'] = h
+
+            held = self.held.get(h)
+            if held is not None:
+                held[2].extend(branches)
+            elif h in completed and replace_mode != 2:
+                self.queue_points(root_path, branches, priority, request)
+            else:
+                self.held[h] = [root_path, trunk['path'], branches, priority,
+                                request]
+                # A trunk still running from before a restart is known.
+                if h not in self.hashes:
+                    self.hashes.add(h)
+                    self.queue_points(root_path, [trunk], priority, request)
+
+    def release_branches(self, h, completed):
+        """
+        Queues the points held back for a trunk that is done, or drops them
+        if it did not complete.
+        """
+        root_path, trunk_path, branches, priority, request = self.held.pop(h)
+        if not completed:
+            print('[!] Trunk %s did not complete, dropping its %d '
+                  'branches.' % (trunk_path, len(branches)))
+            self.hashes.difference_update(e['hash'] for e in branches)
+            return
+
+        print('[*] Trunk %s is done, branching %d experiments off it.' %
+              (trunk_path, len(branches)))
+        self.queue_points(root_path, branches, priority, request)
+        if not self.supervisor:
+            self.done_queue.put(None)
+
+    def start_branching(self):
+        if self.branching:
+            return
+        self.branching = True
+        branch_thread = threading.Thread(target=self.branch_loop)
+        branch_thread.daemon = True
+        branch_thread.start()
+
+    def branch_loop(self):
+        # Finished trunks are noticed on cleanup.
+        while True:
+            time.sleep(BRANCH_INTERVAL)
+            self.cleanup()
+
+    def start_halving(self):
+        if self.halving is not None:
+            return
+        self.halving = HalvingController()
+        halving_thread = threading.Thread(target=self.halving_loop)
+        halving_thread.daemon = True
+        halving_thread.start()
+
+    def prepare_experiments(self, root_path, experiments, replace_mode):
+        """
+        Only creates the directories, protos and scripts of the experiments,
+        in bulk rather than through a worker each. The pool renders and
+        hashes them too, so they are rendered once. Returns their number.
+        """
+        with self.lock:
+            skip = [set(self.hashes)]
+        if replace_mode != 2:
+            skip.append(self.get_completed_index(root_path))
+
+        def points():
+            paths = set()
+            for e in experiments:
+                if e['path'] in paths:
+                    continue
+                paths.add(e['path'])
+                e['caffe_root'] = self.caffe_root
+                e['no_run'] = True
+                e['replace_mode'] = replace_mode
+                yield e
+
+        count = materialize_all(root_path, points(), skip)
+        print('[*] Prepared %d experiments.' % count)
+        return count
+
+    def halving_loop(self):
+        while True:
+            time.sleep(HALVING_INTERVAL)
+            self.check_halving()
+
+    def check_halving(self):
+        """
+        Stops the points of halving sweeps that fell behind at a rung.
+        """
+        entries = self.entries()
+        states = [w.get_state() for w in entries]
+        for w in self.halving.update(entries, states):
+            print('[*] Halving: stopping %s.' % w.experiment['path'])
+            with self.lock:
+                self.halted.add(w.experiment['hash'])
+            w.shutdown()
+
+    @stats.timed
     def terminate(self):
         print('[*] Terminating server...')
         self.kill_all()
+        if not self.supervisor:
+            # Otherwise the dispatcher would still be waiting on the queue
+            # when the interpreter shuts it down.
+            self.done_queue.put(STOP_DISPATCH)
+            self.dispatcher.join()
+        if self.results is not None:
+            self.results.flush()
         print('    Done')
-        self.pyro_daemon.shutdown()
+        if self.pyro_daemon is not None:
+            self.pyro_daemon.shutdown()
 
+    @stats.timed
     def kill(self, worker_idx):
-        self.workers[worker_idx].shutdown()
-        self.workers[worker_idx].join()
+        self.stop_entries([self.listing()[worker_idx]])
+
+    @stats.timed
+    def kill_all(self, grace=None):
+        # Drop the queue first, so that the rest of the sweeps does not move
+        # up while the queued experiments are cancelled.
+        if self.supervisor:
+            dropped = self.supervisor.clear()
+        else:
+            with self.lock:
+                dropped = self.scheduler.clear()
+        self.forget(dropped)
+
+        self.stop_entries(self.entries(), grace)
+
+    def select(self, status=None, path=None, start=None, stop=None):
+        """
+        The listed experiments in the index range [start, stop) that have
+        one of the given statuses, by name or code, and a path matching the
+        `path` glob.
+        """
+        if status is not None and not isinstance(status, (list, tuple)):
+            status = [status]
+        codes = None
+        if status is not None:
+            codes = set(status_code(s) for s in status)
+
+        selected = []
+        for w in self.listing()[start:stop]:
+            if (path is not None and
+                    not fnmatch.fnmatchcase(w.experiment['path'], path)):
+                continue
+            if codes is not None and w.get_state()['status'] not in codes:
+                continue
+            selected.append(w)
+        return selected
+
+    def cancel_queued(self, entries):
+        """
+        Drops the `entries` that are still queued, placeholders of the
+        unexpanded rest of a sweep included, in one go (see
+        `DeviceScheduler.cancel`). Returns the ones that were.
+        """
+        if self.supervisor:
+            dropped = self.supervisor.cancel(entries)
+        else:
+            with self.lock:
+                dropped = self.scheduler.cancel(entries)
+            for p in dropped:
+                p.is_cancelled = True
+        self.forget(dropped)
+        return dropped
+
+    def stop_entries(self, entries, grace=None):
+        """
+        Stops all the `entries` at once and waits until their training
+        processes are gone (see `Worker.stop_training`), so that their
+        devices are free when it returns.
+        """
+        if grace is None:
+            grace = self.kill_grace
+
+        # Queued ones are dropped first, so that their sweeps do not move up
+        # while the rest is stopped.
+        dropped = set(id(w) for w in self.cancel_queued(entries))
+        for w in entries:
+            if id(w) not in dropped:
+                w.shutdown(grace)
+
+        deadline = time.time() + grace + KILL_TIMEOUT
+        for w in entries:
+            w.join(max(deadline - time.time(), 0))
+            if w.is_alive():
+                print('[!] %s is still stopping.' % w.experiment['path'])
         self.cleanup()
 
-    def kill_all(self):
-        for w in self.workers:
-            w.shutdown()
-        self.join_workers()
+    @stats.timed
+    def kill_many(self, status=None, path=None, start=None, stop=None,
+                  grace=None):
+        """
+        Stops the experiments `select` picks, e.g. every running one under
+        a directory:
+
+            kill_many(status='RUNNING', path='lr_sweep/*')
+
+        Queued ones are cancelled. Training processes get `grace` seconds
+        after SIGTERM before SIGKILL, the server's --kill-grace by default.
+        Returns the paths of the stopped experiments once their processes
+        are gone.
+        """
         self.cleanup()
+        entries = [w for w in self.select(status, path, start, stop)
+                   if w.is_alive()]
+        self.stop_entries(entries, grace)
+        return [w.experiment['path'] for w in entries]
+
+    @stats.timed
+    def pause(self, status=None, path=None, start=None, stop=None):
+        """
+        Stops the training processes of the running experiments `select`
+        picks with SIGSTOP, until `resume`. They keep their devices, and
+        their GPU memory, but no longer use any compute. Returns the paths
+        of the paused experiments.
+        """
+        paused = []
+        for w in self.select(status, path, start, stop):
+            pgid = w.get_state().get('pgid', 0)
+            if pgid > 0 and w.set_paused(True):
+                util.signal_group(pgid, signal.SIGSTOP)
+                paused.append(w.experiment['path'])
+        return paused
 
-    def join_workers(self):
-        for w in self.workers:
-            w.join()
+    @stats.timed
+    def resume(self, status=None, path=None, start=None, stop=None):
+        """
+        Continues the paused experiments `select` picks with SIGCONT.
+        Returns the paths of the resumed experiments.
+        """
+        resumed = []
+        for w in self.select(status, path, start, stop):
+            pgid = w.get_state().get('pgid', 0)
+            if pgid > 0 and w.set_paused(False):
+                util.signal_group(pgid, signal.SIGCONT)
+                resumed.append(w.experiment['path'])
+        return resumed
 
     def cleanup(self):
-        self.workers = [w for w in self.workers if w.is_alive()]
+        if self.supervisor:
+            self.forget(self.supervisor.cleanup())
+            return
+
+        with self.lock:
+            done = [w for w in self.workers if not w.is_alive()]
+            self.workers = [w for w in self.workers if w.is_alive()]
+            # The dispatcher does not see the workers dropped here.
+            for w in done:
+                self.reap(w)
+            done.extend(self.scheduler.discard(lambda p: not p.is_alive()))
+            self.forget(done)
+
+    def forget(self, entries):
+        """
+        Drops finished or cancelled entries from the hash index and records
+        the ones that ran.
+        """
+        results = {}
+        with self.lock:
+            for w in entries:
+                h = w.experiment['hash']
+                self.hashes.discard(h)
+                if self.journal is not None:
+                    self.journal.done(h)
+                state = w.get_state()
+                # A halted experiment is done with for good, so that it is
+                # not trained again when its sweep is pushed again.
+                if h in self.halted:
+                    self.halted.discard(h)
+                    if state['status'] != 0 and not is_completed(state):
+                        state['status'] = HALTED
+                if h in self.held:
+                    self.release_branches(h, is_completed(state))
+                if state['status'] == 0:
+                    continue
 
+                root_path = os.path.abspath(w.root_path)
+                if is_completed(state):
+                    results.setdefault(root_path, []).append(
+                        make_result(w.experiment, state))
+
+                self.finished.pop(h, None)
+                self.finished[h] = FinishedExperiment(root_path, w.experiment,
+                                                      state, w.history)
+                if self.results is not None:
+                    self.results.record(root_path, w.experiment, state)
+
+            while len(self.finished) > MAX_FINISHED:
+                self.finished.popitem(last=False)
+
+        for root_path, batch in results.items():
+            self.get_completed_index(root_path).add(batch)
+
+    def listing(self):
+        """
+        The entries followed by the finished experiments that are not live
+        again.
+        """
+        with self.lock:
+            entries = self.entries()
+            live = set(w.experiment['hash'] for w in entries)
+            return entries + [f for f in self.finished.values()
+                              if f.experiment['hash'] not in live]
+
+    def results_loop(self):
+        while True:
+            time.sleep(RESULTS_INTERVAL)
+            self.cleanup()
+            with self.lock:
+                self.track_changes()
+            self.results.flush()
+
+    @stats.timed
+    def get_leaderboard(self, metric, limit=10, descending=True, status=None,
+                        path=None):
+        """
+        Ranks every experiment in the results database, finished or not, by
+        its last value of `metric`.
+        """
+        if self.results is None:
+            raise RuntimeError('The server keeps no results database')
+        if status is not None:
+            status = status_code(status)
+        with self.lock:
+            self.track_changes()
+        self.results.flush()
+        return self.results.leaderboard(metric, limit, descending, status,
+                                        path)
+
+    @stats.timed
+    def get_completed(self, root_path):
+        """
+        Returns the results of the experiments completed under a root path,
+        keyed by experiment hash.
+        """
+        return self.get_completed_index(root_path).results
+
+    @stats.timed
+    def get_history(self, worker_idx, value_name=None, start=0, stop=None):
+        """
+        Returns the buffered (iteration, value) points of one experiment's
+        watched values, or of a single one if `value_name` is given.
+        """
+        return self.listing()[worker_idx].get_history(value_name, start, stop)
+
+    @stats.timed
+    def get_metrics(self, worker_idx, names=None, start=0, stop=None):
+        """
+        Returns the recorded (iteration, value) points of one experiment,
+        read from its metrics store rather than from the log.
+        """
+        return self.listing()[worker_idx].get_metrics(names, start, stop)
+
+    def track_changes(self):
+        """
+        Compares the entries against the last time and assigns sequence
+        numbers to whatever changed since.
+        """
+        entries = self.listing()
+        order = [w.experiment['hash'] for w in entries]
+
+        for w in entries:
+            h = w.experiment['hash']
+            version = w.get_version()
+            t = self.tracked.get(h)
+            if t is None:
+                self.change_seq += 1
+                t = [w, version, self.change_seq, self.change_seq, None]
+                self.tracked[h] = t
+            elif t[0] is not w or t[1] != version:
+                # A queued experiment turns into a new entry once launched.
+                self.change_seq += 1
+                t[0], t[1], t[2] = w, version, self.change_seq
+            else:
+                continue
+
+            t[4] = w.get_state()
+            self.index.update(h, w.experiment, t[4])
+            if self.results is not None and t[4]['status'] != 0:
+                self.results.record(os.path.abspath(w.root_path),
+                                    w.experiment, t[4])
+
+        if order != self.order:
+            present = set(order)
+            for h in self.tracked.keys():
+                if h not in present:
+                    del self.tracked[h]
+                    self.index.remove(h)
+                    self.change_seq += 1
+                    self.removals.append((self.change_seq, h))
+            while len(self.removals) > MAX_REMOVALS:
+                self.removals_floor = self.removals.popleft()[0]
+
+            self.change_seq += 1
+            self.order = order
+            self.order_seq = self.change_seq
+
+    @stats.timed
+    def get_changes(self, since=0):
+        """
+        Returns what changed after the sequence number `since`, which is the
+        `version` of a previous answer (0 at first). Experiment dicts are
+        only sent along with the addition of an entry, states only when
+        they changed. If `reset` is set, the answer holds everything and
+        replaces whatever the caller knew.
+        """
+        self.cleanup()
+
+        with self.lock:
+            self.track_changes()
+
+            reset = since < self.removals_floor or since > self.change_seq
+            if reset:
+                since = 0
+
+            changes = {
+                'version': self.change_seq,
+                'reset': reset,
+                'added': {},
+                'changed': {},
+                'removed': [h for seq, h in self.removals if seq > since]
+                            if since else []
+            }
+            if self.order_seq > since:
+                changes['order'] = self.order
+
+            for h, (w, _, changed_seq, added_seq, state) in \
+                    self.tracked.items():
+                if added_seq > since:
+                    changes['added'][h] = w.experiment
+                if changed_seq > since:
+                    changes['changed'][h] = state
+
+        return changes
+
+    @stats.timed
+    def query(self, status=None, path=None, where=None, sort=None,
+              descending=True, limit=0, fields=None):
+        """
+        Filters, sorts and projects the experiments, e.g. the ten best
+        test_accuracy values among the running ones:
+
+            query(status='RUNNING', sort='test_accuracy', limit=10,
+                  fields=['path', 'test_accuracy'])
+
+        See `ExperimentIndex.query` for the arguments.
+        """
+        self.cleanup()
+
+        with self.lock:
+            self.track_changes()
+            return self.index.query(status, path, where, sort, descending,
+                                    limit, fields)
+
+    @stats.timed
     def get_workers_info(self):
         self.cleanup()
         
         info = []
-        for w in self.workers:
+        for w in self.listing():
             info.append({
                 'state': w.get_state(),
                 'experiment': w.experiment
             })
         return info
 
+    @stats.timed
+    def get_capacity(self):
+        """
+        Returns how much of the server is in use, how much there is in total
+        (None if unlimited) and how much is queued: in devices, or in
+        experiments if the server has no device list. Sweeps count with all
+        the points not drawn yet, at most, and branching sweeps with the
+        points held back for their trunks. The unit it is counted in and the
+        server's grace period for stopping training processes come along.
+        """
+        self.cleanup()
+        lock = self.supervisor.lock if self.supervisor else self.lock
+        with lock:
+            used, total, queued = self.scheduler.capacity()
+        with self.lock:
+            for _, _, branches, _, request in self.held.values():
+                queued += len(branches) * (request if self.scheduler.devices
+                                           else 1)
+        unit = 'devices' if self.scheduler.devices else 'experiments'
+        return {'used': used, 'total': total, 'queued': queued,
+                'unit': unit, 'kill_grace': self.kill_grace}
+
+    @stats.timed
+    def get_stats(self):
+        """
+        Returns the number of live and queued experiments, the log lag of
+        the live ones and, with instrumentation, their parsing and locking
+        counters and the latencies of the server methods. Parsing rates
+        cover the time since the previous call.
+        """
+        self.cleanup()
+
+        now = time.time()
+        experiments = []
+        live = queued = 0
+        with self.lock:
+            samples = {}
+            for w in self.entries():
+                s = w.get_stats()
+                if s is None:
+                    queued += 1
+                    continue
+                live += 1
+
+                h = w.experiment['hash']
+                s['hash'] = h
+                s['path'] = w.experiment['path']
+                if 'lines' in s:
+                    s['lines_per_sec'] = None
+                    last = self.stats_samples.get(h)
+                    if last is not None and now > last[0]:
+                        s['lines_per_sec'] = ((s['lines'] - last[1]) /
+                                              (now - last[0]))
+                    samples[h] = (now, s['lines'])
+                experiments.append(s)
+            self.stats_samples = samples
+
+        return {
+            'enabled': stats.enabled,
+            'time': now,
+            'processes': {'live': live, 'queued': queued},
+            'rpc': stats.rpc.as_dict(),
+            'experiments': experiments
+        }
+
+    def stats_loop(self):
+        while True:
+            time.sleep(STATS_INTERVAL)
+            util.write_atomic(self.stats_path,
+                              stats.prometheus_text(self.get_stats()))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='The automator server.')
     parser.add_argument('-r', '--caffe-root', required=True,
@@ -99,6 +1142,35 @@ if __name__ == '__main__':
     parser.add_argument('-l', '--limit', type=int, default=0,
                         help='maximum number of simultaneously conducted '
                              'experiments (default: 0)')
+    parser.add_argument('-e', '--engine', choices=['process', 'supervisor'],
+                        default='process',
+                        help='run every experiment in a worker process of '
+                             'its own or all of them from a single '
+                             'supervisor loop (default: process)')
+    parser.add_argument('-d', '--devices', default='',
+                        help='comma-separated list of devices to schedule '
+                             'experiments on, e.g. 0,1,2,3 (default: no '
+                             'device accounting)')
+    parser.add_argument('--results', default='~/.automator/results.db',
+                        help='SQLite database to keep the results of all '
+                             'experiments in, empty to keep none '
+                             '(default: ~/.automator/results.db)')
+    parser.add_argument('--journal', default='~/.automator/journal.jsonl',
+                        help='journal of the launched experiments, used to '
+                             'reattach to their training processes after a '
+                             'restart; empty to keep none '
+                             '(default: ~/.automator/journal.jsonl)')
+    parser.add_argument('--stats', action='store_true', default=False,
+                        help='keep counters and timings of log parsing, '
+                             'locking and server calls for get_stats()')
+    parser.add_argument('--stats-file', default='',
+                        help='file to write the stats to every %d seconds '
+                             'in the Prometheus text format; implies '
+                             '--stats' % STATS_INTERVAL)
+    parser.add_argument('--kill-grace', type=float, default=KILL_GRACE,
+                        help='seconds a training process is given to exit '
+                             'on SIGTERM before it gets SIGKILL '
+                             '(default: %g)' % KILL_GRACE)
 
     args = parser.parse_args()
 
@@ -106,13 +1178,22 @@ if __name__ == '__main__':
 
     daemon = Pyro4.Daemon(host='localhost')
 
-    automator_server = AutomatorServer(args.caffe_root, args.limit, daemon)
-    uri = daemon.register(automator_server, 'automator_server')
+    devices = [d for d in args.devices.split(',') if d]
 
     tmp_dir = os.path.expanduser('~/.automator')
     if not os.path.exists(tmp_dir):
         os.mkdir(tmp_dir)
 
+    results_path = os.path.expanduser(args.results)
+    journal_path = os.path.expanduser(args.journal)
+
+    automator_server = AutomatorServer(args.caffe_root, args.limit, daemon,
+                                       args.engine, devices, results_path,
+                                       journal_path, args.stats,
+                                       os.path.expanduser(args.stats_file),
+                                       args.kill_grace)
+    uri = daemon.register(automator_server, 'automator_server')
+
     file(os.path.join(tmp_dir, 'uri'), 'w').write(str(uri))
 
     print('[*] Automator server is running.')
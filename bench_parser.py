@@ -0,0 +1,85 @@
+from __future__ import print_function
+
+import time
+import random
+import argparse
+
+from log_parser import PARSERS
+
+WATCH = ['loss', 'test_accuracy', 'test_loss']
+
+def synthetic_log(num_lines, test_interval=1000, display=20, seed=0):
+    """
+    Produces lines that look like a verbose Caffe training log: mostly
+    layer/solver chatter with periodic iteration and net output reports.
+    """
+    rng = random.Random(seed)
+    lines = ['max_iter: %d\n' % num_lines]
+    noise = [
+        'I0101 00:00:00.000000  1234 net.cpp:150] Setting up conv%d\n',
+        'I0101 00:00:00.000000  1234 net.cpp:157] Top shape: 64 96 55 %d '
+        '(18585600)\n',
+        'I0101 00:00:00.000000  1234 layer_factory.hpp:77] Creating layer '
+        'relu%d\n',
+        'I0101 00:00:00.000000  1234 sgd_solver.cpp:106] Iteration %d, '
+        'lr = 0.01\n'
+    ]
+
+    iteration = 0
+    while len(lines) < num_lines:
+        iteration += 1
+        if iteration % display == 0:
+            loss = rng.random() * 5
+            lines.append('I0101 00:00:00.000000  1234 solver.cpp:228] '
+                         'Iteration %d, loss = %g\n' % (iteration, loss))
+            lines.append('I0101 00:00:00.000000  1234 solver.cpp:244]     '
+                         'Train net output #0: loss = %g (* 1 = %g loss)\n' %
+                         (loss, loss))
+        if iteration % test_interval == 0:
+            lines.append('I0101 00:00:00.000000  1234 solver.cpp:337] '
+                         'Iteration %d, Testing net (#0)\n' % iteration)
+            lines.append('I0101 00:00:00.000000  1234 solver.cpp:404]     '
+                         'Test net output #0: accuracy = %g\n' % rng.random())
+            lines.append('I0101 00:00:00.000000  1234 solver.cpp:404]     '
+                         'Test net output #1: loss = %g (* 1 = %g loss)\n' %
+                         (rng.random(), rng.random()))
+        lines.append(rng.choice(noise) % iteration)
+
+    return lines[:num_lines]
+
+def run(parser_name, lines, repeat):
+    best = None
+    for _ in xrange(repeat):
+        parser = PARSERS[parser_name](WATCH)
+        start = time.time()
+        parser.feed(lines)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return parser, best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Log parser benchmark.')
+    parser.add_argument('-n', '--num-lines', type=int, default=500000)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+
+    args = parser.parse_args()
+
+    lines = synthetic_log(args.num_lines)
+
+    results = {}
+    for name in sorted(PARSERS.keys()):
+        p, elapsed = run(name, lines, args.repeat)
+        results[name] = (p, elapsed)
+        print('{:<8} {:>12.0f} lines/sec  (iter={:g}, max_iter={:g}, '
+              'values={})'.format(name, len(lines) / elapsed, p.iteration,
+                                  p.max_iteration, p.watched_values))
+
+    reference = results['regex'][0]
+    for name, (p, _) in results.items():
+        if (p.iteration, p.max_iteration, p.watched_values) != \
+                (reference.iteration, reference.max_iteration,
+                 reference.watched_values):
+            print('[!] Parser "%s" disagrees with the reference.' % name)
+
+    print('Speedup: {:.1f}x'.format(results['regex'][1] / results['fast'][1]))
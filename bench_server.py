@@ -0,0 +1,396 @@
+from __future__ import print_function
+
+import os
+import sys
+import json
+import stat
+import time
+import shutil
+import tempfile
+import argparse
+import multiprocessing as mp
+
+import Pyro4
+
+from automator_server import AutomatorServer
+from util import read_proc_stat, process_running
+
+FAKE_SRUN = """\
+#!/bin/sh
+# Stand-in for srun: drops the options and runs the command in place.
+while [ $# -gt 0 ]; do
+    case "$1" in
+        --*) shift ;;
+        *) break ;;
+    esac
+done
+exec "$@"
+"""
+
+FAKE_CAFFE = """\
+#!%(python)s
+# Stand-in for build/tools/caffe: writes a Caffe-like training log to
+# stderr at %(rate)g iterations per second.
+import os
+import sys
+import json
+import time
+import random
+
+RATE = %(rate)r
+NOISE = %(noise)d
+
+args = dict(a[2:].split('=', 1) for a in sys.argv[2:]
+            if a.startswith('--') and '=' in a)
+solver_path = args['solver']
+solver = open(solver_path).read()
+params = dict(line.split(':', 1) for line in solver.splitlines()
+              if ':' in line)
+max_iter = int(params['max_iter'])
+display = int(params['display'])
+test_interval = int(params['test_interval'])
+
+start = time.time()
+with open(os.path.join(os.path.dirname(solver_path), 'caffe.start'),
+          'w') as f:
+    json.dump({'pid': os.getpid(), 'time': start}, f)
+
+pid = os.getpid()
+def log(where, message):
+    now = time.time()
+    sys.stderr.write('I%%s.%%06d %%5d %%s] %%s\\n' %% (
+        time.strftime('%%m%%d %%H:%%M:%%S', time.localtime(now)),
+        (now %% 1) * 1e6, pid, where, message))
+
+log('caffe.cpp:210', 'Using GPUs %%s' %% args.get('gpu', '0'))
+log('solver.cpp:48', 'Initializing solver from parameters: ')
+sys.stderr.write(solver)
+for i in range(NOISE):
+    log('net.cpp:150', 'Setting up conv%%d' %% i)
+    log('net.cpp:157', 'Top shape: 64 96 55 55 (18585600)')
+sys.stderr.flush()
+
+rng = random.Random(pid)
+for iteration in range(max_iter + 1):
+    if iteration %% test_interval == 0:
+        log('solver.cpp:337', 'Iteration %%d, Testing net (#0)' %% iteration)
+        accuracy = 1 - 1.0 / (1 + iteration * rng.uniform(0.5, 1.5))
+        log('solver.cpp:404', '    Test net output #0: accuracy = %%g' %%
+            accuracy)
+        log('solver.cpp:404', '    Test net output #1: loss = %%g '
+            '(* 1 = %%g loss)' %% (1 - accuracy, 1 - accuracy))
+    if iteration %% display == 0:
+        loss = 5.0 / (1 + iteration) * rng.uniform(0.5, 1.5)
+        log('solver.cpp:228', 'Iteration %%d, loss = %%g' %% (iteration, loss))
+        log('solver.cpp:244', '    Train net output #0: loss = %%g '
+            '(* 1 = %%g loss)' %% (loss, loss))
+        sys.stderr.flush()
+    log('sgd_solver.cpp:106', 'Iteration %%d, lr = 0.01' %% iteration)
+
+    delay = start + (iteration + 1) / RATE - time.time()
+    if delay > 0:
+        time.sleep(delay)
+
+log('solver.cpp:464', 'Optimization Done.')
+log('caffe.cpp:246', 'Optimization Done.')
+"""
+
+MODEL_TEMPLATE = 'name: "bench" # ${x}\n'
+
+SOLVER_TEMPLATE = """\
+net: "${net}"
+max_iter: %(max_iter)d
+display: %(display)d
+test_interval: %(test_interval)d
+base_lr: 0.01
+snapshot_prefix: "${root}/${path}/snapshots/bench"
+"""
+
+def write_file(path, data, executable=False):
+    with open(path, 'w') as f:
+        f.write(data)
+    if executable:
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP |
+                 stat.S_IXOTH)
+
+def setup(work_dir, args):
+    """
+    Lays out a fake Caffe distribution, a fake srun and a sweep of
+    `args.num_experiments` experiments under `work_dir`. Returns the Caffe
+    root, the directory to put on PATH and the sweep file.
+    """
+    caffe_root = os.path.join(work_dir, 'caffe')
+    tools_path = os.path.join(caffe_root, 'build', 'tools')
+    bin_path = os.path.join(work_dir, 'bin')
+    os.makedirs(tools_path)
+    os.makedirs(bin_path)
+
+    write_file(os.path.join(bin_path, 'srun'), FAKE_SRUN, True)
+    write_file(os.path.join(tools_path, 'caffe'), FAKE_CAFFE % {
+        'python': sys.executable,
+        'rate': args.rate,
+        'noise': args.noise
+    }, True)
+
+    model_path = os.path.join(work_dir, 'model.tpl')
+    solver_path = os.path.join(work_dir, 'solver.tpl')
+    write_file(model_path, MODEL_TEMPLATE)
+    write_file(solver_path, SOLVER_TEMPLATE % {
+        'max_iter': args.max_iter,
+        'display': args.display,
+        'test_interval': args.test_interval
+    })
+
+    sweep = {
+        'root_path': os.path.join(work_dir, 'experiments'),
+        'defaults': {
+            'description': 'benchmark',
+            'watch': ['loss', 'test_accuracy'],
+            'model': {'template': model_path},
+            'solver': {'template': solver_path}
+        },
+        'experiments': [{
+            'path': 'bench_${model_x}',
+            'model': {'values': {'x': range(args.num_experiments)}}
+        }]
+    }
+    sweep_path = os.path.join(work_dir, 'sweep.yaml')
+    # JSON is valid YAML.
+    write_file(sweep_path, json.dumps(sweep, indent=2))
+
+    return caffe_root, bin_path, sweep_path
+
+def read_start(root_path, experiment):
+    """
+    Returns the pid and start time the fake Caffe of an experiment left
+    behind, or None if it has not started yet.
+    """
+    path = os.path.join(root_path, experiment['path'], 'protos',
+                        'caffe.start')
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def rss_mb(key='VmRSS'):
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1]) / 1024.0
+    return None
+
+def cpu_seconds(pid):
+    stat = read_proc_stat(pid)
+    if stat is None:
+        return None
+    return (int(stat[11]) + int(stat[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+def summary(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        'p50': values[len(values) // 2],
+        'p95': values[min(int(len(values) * 0.95), len(values) - 1)],
+        'max': values[-1]
+    }
+
+def wait_exited(pids, timeout):
+    """
+    Waits until none of the given processes runs. Returns how long that
+    took, or None on timeout.
+    """
+    start = time.time()
+    while any(process_running(pid) for pid in pids):
+        if time.time() - start > timeout:
+            return None
+        time.sleep(0.01)
+    return time.time() - start
+
+class Benchmark(object):
+    """
+    Drives an in-process `AutomatorServer` with one sweep and samples how
+    it keeps up. The staleness of an experiment is how long ago the fake
+    Caffe wrote the iteration the server reports. Even a server that keeps
+    up shows up to `display / rate` plus the polling interval.
+    """
+    def __init__(self, server, root_path, rate, poll_interval):
+        self.server = server
+        self.root_path = root_path
+        self.rate = rate
+        self.poll_interval = poll_interval
+
+        # path -> {'pid', 'time'} of the started fake Caffes
+        self.starts = {}
+        self.staleness = []
+        # pid -> CPU seconds of the worker processes, as last sampled
+        self.worker_cpu = {}
+        self.peak_rss = 0
+
+    def sample(self):
+        info = self.server.get_workers_info()
+        now = time.time()
+
+        for w in info:
+            experiment = w['experiment']
+            state = w['state']
+            path = experiment['path']
+
+            start = self.starts.get(path)
+            if start is None:
+                start = read_start(self.root_path, experiment)
+                if start is None:
+                    continue
+                self.starts[path] = start
+
+            if state['status'] == 1 and state['iter'] > 0:
+                emitted = start['time'] + state['iter'] / self.rate
+                self.staleness.append(max(now - emitted, 0))
+
+        for child in mp.active_children():
+            cpu = cpu_seconds(child.pid)
+            if cpu is not None:
+                self.worker_cpu[child.pid] = cpu
+
+        self.peak_rss = max(self.peak_rss, rss_mb())
+        return info
+
+    def running_pids(self):
+        return [start['pid'] for start in self.starts.values()
+                if process_running(start['pid'])]
+
+    def run(self, sweep_path, num_experiments, duration):
+        results = {}
+
+        start = time.time()
+        self.server.push_experiments(sweep_path)
+        results['push_latency'] = time.time() - start
+
+        finished = 0
+        while time.time() - start < duration:
+            info = self.sample()
+            finished = sum(1 for w in info if w['state']['status'] == 2)
+            if finished >= num_experiments:
+                break
+            time.sleep(self.poll_interval)
+
+        results['elapsed'] = time.time() - start
+        results['finished'] = finished
+        if self.starts:
+            results['time_to_first_launch'] = min(
+                s['time'] for s in self.starts.values()) - start
+        else:
+            results['time_to_first_launch'] = None
+        results['staleness'] = summary(self.staleness)
+
+        server_cpu = os.times()
+        results['server'] = {
+            'rss_mb': rss_mb(),
+            'peak_rss_mb': max(self.peak_rss, rss_mb('VmHWM')),
+            'cpu_seconds': server_cpu[0] + server_cpu[1]
+        }
+        results['workers'] = {
+            'count': len(self.worker_cpu),
+            'cpu_seconds': summary(self.worker_cpu.values())
+        }
+
+        results['kill_latency'] = self.measure_kill()
+        results['terminate_latency'] = self.measure_terminate()
+        return results
+
+    def measure_kill(self):
+        """
+        Kills the first running experiment. Returns how long the call took
+        and how long until its training process was gone.
+        """
+        self.sample()
+        for idx, w in enumerate(self.server.get_workers_info()):
+            start = self.starts.get(w['experiment']['path'])
+            if (w['state']['status'] == 1 and start is not None and
+                    process_running(start['pid'])):
+                break
+        else:
+            return None
+
+        begin = time.time()
+        self.server.kill(idx)
+        call = time.time() - begin
+        return {'call': call, 'exited': wait_exited([start['pid']], 60)}
+
+    def measure_terminate(self):
+        """
+        Terminates the server with whatever still runs. Returns how long the
+        call took and how long until every training process was gone.
+        """
+        self.sample()
+        pids = self.running_pids()
+
+        begin = time.time()
+        self.server.terminate()
+        call = time.time() - begin
+        return {
+            'call': call,
+            'exited': wait_exited(pids, 60),
+            'running': len(pids)
+        }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='End-to-end load benchmark of the automator server, '
+                    'with a stand-in Caffe and srun.')
+    parser.add_argument('-n', '--num-experiments', type=int, default=50)
+    parser.add_argument('-e', '--engine', choices=['process', 'supervisor'],
+                        default='process')
+    parser.add_argument('-l', '--limit', type=int, default=0)
+    parser.add_argument('--rate', type=float, default=200.0,
+                        help='iterations per second of every fake Caffe '
+                             '(default: 200)')
+    parser.add_argument('--max-iter', type=int, default=20000)
+    parser.add_argument('--display', type=int, default=20)
+    parser.add_argument('--test-interval', type=int, default=500)
+    parser.add_argument('--noise', type=int, default=100,
+                        help='layer setup lines logged at startup '
+                             '(default: 100)')
+    parser.add_argument('-d', '--duration', type=float, default=30.0,
+                        help='seconds to follow the sweep before killing '
+                             'what still runs (default: 30)')
+    parser.add_argument('--poll-interval', type=float, default=0.1)
+    parser.add_argument('-o', '--output', default='',
+                        help='file to write the JSON results to '
+                             '(default: stdout)')
+    parser.add_argument('-k', '--keep', action='store_true', default=False,
+                        help='keep the working directory')
+
+    args = parser.parse_args()
+
+    # Keep the messages of the server out of the results.
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+
+    work_dir = tempfile.mkdtemp(prefix='automator_bench_')
+    try:
+        caffe_root, bin_path, sweep_path = setup(work_dir, args)
+        os.environ['PATH'] = bin_path + os.pathsep + os.environ['PATH']
+        os.chdir(caffe_root)
+
+        daemon = Pyro4.Daemon(host='localhost')
+        server = AutomatorServer(caffe_root, args.limit, daemon, args.engine)
+
+        benchmark = Benchmark(server, os.path.join(work_dir, 'experiments'),
+                              args.rate, args.poll_interval)
+        results = benchmark.run(sweep_path, args.num_experiments,
+                                args.duration)
+        results['config'] = vars(args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output, file=stdout)
@@ -0,0 +1,389 @@
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import threading
+import functools
+import Pyro4
+
+from results import INDEX_NAME
+from automator_server import AutomatorServer
+from federation import Federation
+from worker import KILL_TIMEOUT
+from util import process_group_running
+from bench_server import FAKE_SRUN, write_file
+
+FAKE_CAFFE = """\
+#!%(python)s
+# Stand-in for build/tools/caffe: logs the iterations at multiples of
+# display, as Caffe does, snapshots at max_iter and records every call in
+# calls.log next to itself.
+import os
+import re
+import sys
+import json
+import time
+
+args = dict(a[2:].split('=', 1) for a in sys.argv[2:]
+            if a.startswith('--') and '=' in a)
+solver = open(args['solver']).read()
+max_iter = int(re.search(r'max_iter: *(\\d+)', solver).group(1))
+display = int(re.search(r'display: *(\\d+)', solver).group(1))
+prefix = re.search(r'snapshot_prefix: "([^"]+)"', solver).group(1)
+
+start = 0
+if 'snapshot' in args:
+    start = int(open(args['snapshot']).read())
+
+calls_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'calls.log')
+with open(calls_path, 'a') as f:
+    f.write(json.dumps({'solver': args['solver'],
+                        'snapshot': args.get('snapshot')}) + '\\n')
+
+sys.stderr.write(solver + '\\n')
+for iteration in range(start, max_iter + 1):
+    if iteration %% display:
+        continue
+    sys.stderr.write('I0101 solver.cpp:228] Iteration ' + str(iteration) +
+                     ', loss = ' + repr(1.0 / (iteration + 1)) + '\\n')
+    sys.stderr.flush()
+    time.sleep(0.01)
+
+if not os.path.isdir(os.path.dirname(prefix)):
+    os.makedirs(os.path.dirname(prefix))
+for ext, what in [('caffemodel', ''), ('solverstate', 'solver state ')]:
+    path = prefix + '_iter_' + str(max_iter) + '.' + ext
+    with open(path, 'w') as f:
+        f.write(str(max_iter))
+    sys.stderr.write('I0101 solver.cpp:454] Snapshotting ' + what +
+                     'to binary proto file ' + path + '\\n')
+"""
+
+# A training command that ignores SIGTERM, and so has to be killed.
+STUBBORN_TRAINER = """\
+import sys
+import time
+import signal
+
+signal.signal(signal.SIGTERM, signal.SIG_IGN)
+iteration = 0
+while True:
+    sys.stderr.write('I0101 solver.cpp:228] Iteration %d, loss = 1\\n' %
+                     iteration)
+    sys.stderr.flush()
+    time.sleep(0.05)
+    iteration += 1
+"""
+
+MODEL_TEMPLATE = 'name: "check" # ${x}\n'
+
+SOLVER_TEMPLATE = """\
+net: "${net}"
+base_lr: ${base_lr}
+gamma: ${gamma}
+max_iter: ${max_iter}
+display: ${display}
+snapshot_prefix: "${root}/${path}/snapshots/check"
+"""
+
+class CheckFailed(Exception):
+    pass
+
+def check(condition, message):
+    if not condition:
+        raise CheckFailed(message)
+
+def wait_for(predicate, timeout, what):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise CheckFailed('Timed out waiting for ' + what)
+        time.sleep(0.1)
+
+def setup(work_dir):
+    """
+    Lays out a fake Caffe distribution, a fake srun and the templates
+    under `work_dir`. Returns the Caffe root and the directory to put on
+    PATH.
+    """
+    caffe_root = os.path.join(work_dir, 'caffe')
+    tools_path = os.path.join(caffe_root, 'build', 'tools')
+    bin_path = os.path.join(work_dir, 'bin')
+    os.makedirs(tools_path)
+    os.makedirs(bin_path)
+
+    write_file(os.path.join(bin_path, 'srun'), FAKE_SRUN, True)
+    write_file(os.path.join(tools_path, 'caffe'),
+               FAKE_CAFFE % {'python': sys.executable}, True)
+    write_file(os.path.join(work_dir, 'stubborn.py'), STUBBORN_TRAINER)
+    write_file(os.path.join(work_dir, 'model.tpl'), MODEL_TEMPLATE)
+    write_file(os.path.join(work_dir, 'solver.tpl'), SOLVER_TEMPLATE)
+    return caffe_root, bin_path
+
+def write_sweep(work_dir, name, experiments, **defaults):
+    sweep = {
+        'root_path': os.path.join(work_dir, 'experiments'),
+        'defaults': dict({
+            'description': 'check',
+            'watch': ['loss'],
+            'model': {'template': os.path.join(work_dir, 'model.tpl'),
+                      'values': {'x': 0}},
+            'solver': {'template': os.path.join(work_dir, 'solver.tpl'),
+                       'values': {'base_lr': 0.01, 'gamma': 0.1,
+                                  'max_iter': 100, 'display': 10}}
+        }, **defaults),
+        'experiments': experiments
+    }
+    path = os.path.join(work_dir, name + '.yaml')
+    # JSON is valid YAML.
+    write_file(path, json.dumps(sweep, indent=2))
+    return path
+
+def read_calls(caffe_root):
+    path = os.path.join(caffe_root, 'build', 'tools', 'calls.log')
+    try:
+        with open(path, 'r') as f:
+            return [json.loads(line) for line in f]
+    except IOError:
+        return []
+
+def forget_completed(root_path, paths):
+    """
+    Drops the experiments at `paths` from the completed index and removes
+    their directories, as if the run had stopped before starting them.
+    """
+    for path in paths:
+        shutil.rmtree(os.path.join(root_path, path))
+    index_path = os.path.join(root_path, INDEX_NAME)
+    with open(index_path, 'r') as f:
+        lines = [line for line in f
+                 if json.loads(line)['path'] not in paths]
+    write_file(index_path, ''.join(lines))
+
+def is_idle(server):
+    server.cleanup()
+    return not server.entries() and not server.held
+
+def check_branching(work_dir, caffe_root, engine, at=50, display=10):
+    """
+    A branching sweep trains every trunk once, then resumes each branch
+    from the last snapshot of its trunk. Pushed again to a new server with
+    only the last branches left, the completed trunks are recognised and
+    just those branches run again. The trunks complete by their snapshot
+    at `at` even if its iteration is never logged, being no multiple of
+    `display`.
+    """
+    sweep_path = write_sweep(work_dir, 'branching', [{
+        'path': 'branch_${solver_base_lr}_${solver_gamma}',
+        'unroll': 'product',
+        'solver': {'values': {'base_lr': [0.1, 0.01],
+                              'gamma': [0.1, 0.5, 0.9],
+                              'display': display}},
+        'branch': {'at': at, 'values': ['gamma']}
+    }])
+
+    server = AutomatorServer(caffe_root, 2, None, engine)
+    server.push_experiments(sweep_path)
+    wait_for(lambda: is_idle(server), 60, 'the branching sweep')
+
+    calls = read_calls(caffe_root)
+    trunks = [c for c in calls if '/trunks/' in c['solver']]
+    branches = [c for c in calls if '/trunks/' not in c['solver']]
+    check(len(trunks) == 2, '%d trunk runs, expected 2' % len(trunks))
+    check(all(c['snapshot'] is None for c in trunks),
+          'A trunk was resumed from a snapshot')
+    check(len(branches) == 6, '%d branch runs, expected 6' % len(branches))
+    check(all(c['snapshot'] and '/trunks/' in c['snapshot'] and
+              c['snapshot'].endswith('_iter_%d.solverstate' % at)
+              for c in branches),
+          'A branch did not start from the snapshot of its trunk')
+    server.terminate()
+
+    forget_completed(os.path.join(work_dir, 'experiments'),
+                     ['branch_0.1_0.9', 'branch_0.01_0.9'])
+
+    server = AutomatorServer(caffe_root, 2, None, engine)
+    server.push_experiments(sweep_path)
+    wait_for(lambda: is_idle(server), 60, 'the pushed again sweep')
+    calls = read_calls(caffe_root)[len(calls):]
+    check(not any('/trunks/' in c['solver'] for c in calls),
+          'A completed trunk was trained again')
+    check(sorted(c['solver'].split('/')[-3] for c in calls) ==
+          ['branch_0.01_0.9', 'branch_0.1_0.9'],
+          'Ran %s, expected the two forgotten branches' %
+          [c['solver'] for c in calls])
+    check(all(c['snapshot'] and '/trunks/' in c['snapshot']
+              for c in calls),
+          'A forgotten branch did not start from the snapshot of its trunk')
+    server.terminate()
+
+def serve(caffe_root, limit, engine):
+    """
+    Starts a server with a Pyro daemon of its own, served from a background
+    thread. Returns the server and its URI.
+    """
+    daemon = Pyro4.Daemon(host='localhost')
+    server = AutomatorServer(caffe_root, limit, daemon, engine)
+    uri = daemon.register(server, 'automator_server')
+    thread = threading.Thread(target=daemon.requestLoop)
+    thread.daemon = True
+    thread.start()
+    return server, str(uri)
+
+def check_sharding(work_dir, caffe_root, engine):
+    """
+    A sweep pushed to a federation of two idle servers is split evenly
+    between them, and every point goes to exactly one of them. Once one
+    server has a sweep of its own queued, the next push goes to the other,
+    until the loads, counted in experiments, are even. Kills by index are
+    refused while a server does not answer.
+    """
+    def write_shard_sweep(name, base_lrs=(0.1, 0.01), gpus=1):
+        return write_sweep(work_dir, name, [{
+            'path': name + '_${solver_base_lr}_${solver_gamma}',
+            'unroll': 'product',
+            'gpus': gpus,
+            'solver': {'values': {'base_lr': list(base_lrs),
+                                  'gamma': [0.1, 0.5, 0.9],
+                                  'max_iter': 100000}}
+        }])
+
+    servers, uris = zip(*[serve(caffe_root, 2, engine) for _ in xrange(2)])
+    try:
+        federation = Federation(uris)
+        counts = federation.push_experiments(write_shard_sweep('shard'))
+        check(sorted(counts.values()) == [3, 3],
+              'Queued %r, expected 3 experiments on each server' % counts)
+
+        paths = {}
+        for i, _, w in federation.listing():
+            paths.setdefault(i, set()).add(w['experiment']['path'])
+        check(sorted(len(p) for p in paths.values()) == [3, 3],
+              'Listed %r, expected 3 experiments on each server' % paths)
+        check(set.union(*paths.values()) ==
+              set('shard_%s_%s' % (lr, gamma) for lr in [0.1, 0.01]
+                  for gamma in [0.1, 0.5, 0.9]),
+              'The servers do not cover the sweep: %r' % paths)
+
+        # Both servers count in experiments, whatever the points request.
+        servers[0].push_experiments(write_shard_sweep('own'))
+        counts = federation.push_experiments(write_shard_sweep(
+            'more', [0.1, 0.01, 0.001, 0.0001], 0.5))
+        check(counts == {uris[0]: 3, uris[1]: 9},
+              'Queued %r, expected 3 experiments on %s and 9 on %s' %
+              (counts, uris[0], uris[1]))
+
+        partial = Federation([uris[0], 'localhost:1'], timeout=1)
+        try:
+            partial.kill(0)
+        except RuntimeError:
+            pass
+        else:
+            check(False, 'Killed by index with a server missing')
+    finally:
+        for server in servers:
+            server.terminate()
+
+def check_escalation(work_dir, caffe_root, engine):
+    """
+    Training processes that ignore SIGTERM are killed once the grace period
+    is over, and their devices are free when `kill_many` returns. The rest
+    of the sweep, queued behind them, is cancelled along with them rather
+    than moving up.
+    """
+    sweep_path = write_sweep(work_dir, 'escalation', [{
+        'path': 'stubborn_${model_x}',
+        'command': '%s %s' % (sys.executable,
+                              os.path.join(work_dir, 'stubborn.py')),
+        'model': {'values': {'x': [0, 1, 2, 3]}}
+    }])
+
+    server = AutomatorServer(caffe_root, 2, None, engine)
+    server.push_experiments(sweep_path)
+
+    def pgids():
+        states = [w.get_state() for w in server.listing()]
+        return [s['pgid'] for s in states if s['status'] == 1]
+    wait_for(lambda: len(pgids()) == 2 and all(p > 0 for p in pgids()), 30,
+             'the stubborn experiments to start')
+    running = pgids()
+
+    grace = 1
+    start = time.time()
+    stopped = server.kill_many(path='stubborn_*', grace=grace)
+    elapsed = time.time() - start
+
+    check(sorted(stopped) == ['stubborn_%d' % i for i in range(4)],
+          'Stopped %r, expected every experiment' % stopped)
+    check(elapsed >= grace,
+          'kill_many returned after %.1f s, before the grace period' %
+          elapsed)
+    check(elapsed < grace + KILL_TIMEOUT,
+          'kill_many took %.1f s with a grace period of %d s' %
+          (elapsed, grace))
+    check(not any(process_group_running(p) for p in running),
+          'A training process outlived kill_many')
+    check(server.get_capacity()['used'] == 0,
+          'The devices of the killed experiments are still in use')
+    time.sleep(1)
+    server.cleanup()
+    check(not server.entries(),
+          'Cancelled experiments are still listed: %r' %
+          [w.experiment['path'] for w in server.entries()])
+    check(not os.path.exists(os.path.join(work_dir, 'experiments',
+                                          'stubborn_3')),
+          'A cancelled experiment was started')
+    server.terminate()
+
+CHECKS = [
+    ('branching', check_branching),
+    ('uneven_branching', functools.partial(check_branching, at=55,
+                                           display=20)),
+    ('sharding', check_sharding),
+    ('escalation', check_escalation)
+]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='End-to-end checks of the automator server, with a '
+                    'stand-in Caffe and srun.')
+    parser.add_argument('checks', nargs='*',
+                        help='checks to run: %s (default: all)' %
+                             ', '.join(name for name, _ in CHECKS))
+    parser.add_argument('-e', '--engine', action='append',
+                        choices=['process', 'supervisor'],
+                        help='engine to check, may be repeated (default: '
+                             'both)')
+    parser.add_argument('-k', '--keep', action='store_true', default=False,
+                        help='keep the working directories')
+
+    args = parser.parse_args()
+
+    checks = [(name, f) for name, f in CHECKS
+              if not args.checks or name in args.checks]
+    engines = args.engine or ['process', 'supervisor']
+
+    failed = 0
+    for name, f in checks:
+        for engine in engines:
+            work_dir = tempfile.mkdtemp(prefix='automator_check_')
+            try:
+                caffe_root, bin_path = setup(work_dir)
+                os.environ['PATH'] = bin_path + os.pathsep + os.environ['PATH']
+                os.chdir(caffe_root)
+                f(work_dir, caffe_root, engine)
+                print('[*] %s (%s): ok' % (name, engine))
+            except CheckFailed as e:
+                failed += 1
+                print('[!] %s (%s): %s' % (name, engine, e))
+            finally:
+                if not args.keep:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+
+    sys.exit(1 if failed else 0)
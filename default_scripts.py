@@ -12,10 +12,10 @@ $$TOOLS/caffe train \\
 PLOT_TEMPLATE = """\
 #!/usr/bin/env sh
 
-python ./tools/extra/parse_log.py \\
-    ${logs_path}/log.txt \\
-    ${logs_path}
+# Usage: plot.sh OUTPUT_IMAGE [METRIC ...]
+OUTPUT=$$1
+shift
 
-python ./tools/extra/plot_log.py \\
-    ${logs_path}/log.txt.$$1 -f $$2 -r $$3
+python ${automator_path}/metrics_store.py \\
+    ${metrics_path} "$$@" -o $$OUTPUT
 """
@@ -0,0 +1,340 @@
+from __future__ import print_function
+
+import time
+import threading
+import Queue
+from collections import OrderedDict
+import Pyro4
+
+import preprocessing
+from worker import KILL_GRACE, KILL_TIMEOUT
+from monitor import WorkersMirror
+
+DEFAULT_TIMEOUT = 5.0
+# Pushing renders every point of a share, and materializes it with
+# --no-run, so it is given much longer.
+PUSH_TIMEOUT = 300.0
+
+class ServerTimeout(Exception):
+    pass
+
+def make_uri(address):
+    """
+    Accepts a full Pyro URI or just host:port of a server.
+    """
+    if address.startswith('PYRO'):
+        return address
+    return 'PYRO:automator_server@%s' % address
+
+class Call(object):
+    def __init__(self, method, args, timeout):
+        self.method = method
+        self.args = args
+        self.timeout = timeout
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self, proxy):
+        proxy._pyroTimeout = self.timeout
+        try:
+            self.result = getattr(proxy, self.method)(*self.args)
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+class RemoteServer(object):
+    """
+    Connection to one server. Calls are made from a thread of its own, so
+    that a slow or dead server only holds up its own calls; a new call is
+    refused while the previous one has not returned.
+    """
+    def __init__(self, address):
+        self.uri = make_uri(address)
+        self.calls = Queue.Queue()
+        self.last_call = None
+
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        proxy = Pyro4.Proxy(self.uri)
+        while True:
+            self.calls.get().run(proxy)
+
+    def submit(self, method, args, timeout):
+        if self.last_call is not None and not self.last_call.done.is_set():
+            return None
+        self.last_call = Call(method, args, timeout)
+        self.calls.put(self.last_call)
+        return self.last_call
+
+class Federation(object):
+    """
+    Several servers used as one. Every call goes out to all of them at
+    once and waits at most `timeout` seconds; sweeps are sharded across
+    them by free capacity. It offers the server methods the client needs,
+    so it can stand in for a single server proxy.
+    """
+    def __init__(self, addresses, timeout=DEFAULT_TIMEOUT):
+        self.servers = [RemoteServer(a) for a in addresses]
+        self.timeout = timeout
+
+    def fan_out(self, calls, timeout=None):
+        """
+        Makes the given (server index, method, args) calls concurrently.
+        Returns the result of each, or the exception it raised; a server
+        that does not answer within `timeout` seconds, the federation's
+        timeout by default, gets a `ServerTimeout`.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        pending = [(i, self.servers[i].submit(method, args, timeout))
+                   for i, method, args in calls]
+        deadline = time.time() + timeout
+
+        results = []
+        for i, call in pending:
+            uri = self.servers[i].uri
+            if call is None:
+                results.append(ServerTimeout('%s is busy' % uri))
+            elif not call.done.wait(max(deadline - time.time(), 0)):
+                results.append(ServerTimeout('%s timed out' % uri))
+            elif call.error is not None:
+                results.append(call.error)
+            else:
+                results.append(call.result)
+        return results
+
+    def call(self, method, *args, **kwargs):
+        return self.fan_out([(i, method, args)
+                             for i in xrange(len(self.servers))], **kwargs)
+
+    def stop_timeout(self, grace):
+        """
+        How long to wait for servers stopping experiments with the given
+        grace period, or else the longest of their own ones.
+        """
+        if grace is None:
+            graces = [c.get('kill_grace', KILL_GRACE) for c in
+                      self.report(self.call('get_capacity')).values()]
+            grace = max(graces or [KILL_GRACE])
+        return self.timeout + grace + KILL_TIMEOUT
+
+    def report(self, results, indices=None):
+        """
+        Prints the errors among the `results` of calls to the servers with
+        the given indices (all of them by default) and returns the rest, by
+        server index.
+        """
+        if indices is None:
+            indices = xrange(len(self.servers))
+
+        answers = {}
+        for i, result in zip(indices, results):
+            if isinstance(result, Exception):
+                print('[!] %s: %s' % (self.servers[i].uri, result))
+            else:
+                answers[i] = result
+        return answers
+
+    def push_experiments(self, path, replace_mode=0, no_run=False):
+        """
+        Unrolls a sweep file and sends every server a share of its points,
+        filling up the least loaded server first. The points of a halving
+        sweep are compared with each other and those of a branching sweep
+        share trunks, so either goes to one server as a whole.
+        The templates have to be readable from every server. Returns the
+        number of experiments queued, by server URI.
+        """
+        root_path, sweeps = preprocessing.load_sweeps(path)
+
+        capacities = self.report(self.call('get_capacity'))
+        if not capacities:
+            raise RuntimeError('None of the servers answered')
+
+        # server index -> [used + queued + assigned, total, whether counted
+        # in experiments rather than devices]
+        loads = {}
+        for i, c in capacities.items():
+            loads[i] = [c['used'] + c['queued'], c['total'] or 1,
+                        c.get('unit') == 'experiments']
+        shares = dict((i, []) for i in capacities)
+
+        def assign(points):
+            i = min(loads, key=lambda i: (loads[i][0] / float(loads[i][1]),
+                                          i))
+            shares[i].extend(points)
+            if loads[i][2]:
+                loads[i][0] += len(points)
+            else:
+                loads[i][0] += sum(e['gpus'] for e in points)
+
+        for sweep in sweeps:
+            points = preprocessing.iter_unrolled(sweep)
+            if sweep['unroll'] == 'halving' or sweep['branch']['at'] > 0:
+                assign(list(points))
+            else:
+                for e in points:
+                    assign([e])
+
+        calls = [(i, 'push_experiment_list',
+                  (root_path, points, replace_mode, no_run))
+                 for i, points in sorted(shares.items()) if points]
+        answers = self.report(self.fan_out(calls, PUSH_TIMEOUT),
+                              [i for i, _, _ in calls])
+
+        counts = {}
+        for i, count in sorted(answers.items()):
+            uri = self.servers[i].uri
+            print('[*] %s: queued %d experiments.' % (uri, count))
+            counts[uri] = count
+        return counts
+
+    def listing(self, complete=False):
+        """
+        The experiments of every server that answered, in server order,
+        each with the index of its server and its index there. With
+        `complete`, a server that does not answer raises a RuntimeError
+        instead, as indices into the merged listing would be off.
+        """
+        results = self.call('get_workers_info')
+        missing = [self.servers[i].uri for i, result in enumerate(results)
+                   if isinstance(result, Exception)]
+        if complete and missing:
+            raise RuntimeError('Indices are over the experiments of every '
+                               'server, and %s did not answer' %
+                               ', '.join(missing))
+
+        listing = []
+        for i, info in sorted(self.report(results).items()):
+            listing.extend((i, idx, w) for idx, w in enumerate(info))
+        return listing
+
+    def get_workers_info(self):
+        return [w for _, _, w in self.listing()]
+
+    def kill(self, worker_idx):
+        i, idx, _ = self.listing(complete=True)[worker_idx]
+        self.report(self.fan_out([(i, 'kill', (idx,))],
+                                 self.stop_timeout(None)), [i])
+
+    def kill_all(self, grace=None):
+        self.report(self.call('kill_all', grace,
+                              timeout=self.stop_timeout(grace)))
+
+    def terminate(self):
+        self.report(self.call('terminate', timeout=self.stop_timeout(None)))
+
+    def select_calls(self, method, status, path, start, stop, *args):
+        """
+        Calls of one of the methods taking `AutomatorServer.select` filters,
+        for every server. An index range is over the merged listing, so it
+        is split into the ranges of the servers it covers, and refused
+        while a server does not answer.
+        """
+        if start is None and stop is None:
+            return [(i, method, (status, path, None, None) + args)
+                    for i in xrange(len(self.servers))]
+
+        counts = OrderedDict()
+        for i, _, _ in self.listing(complete=True):
+            counts[i] = counts.get(i, 0) + 1
+        if start is None:
+            start = 0
+        if stop is None:
+            stop = sum(counts.values())
+
+        calls = []
+        offset = 0
+        for i, count in counts.items():
+            lo = min(max(start - offset, 0), count)
+            hi = min(max(stop - offset, 0), count)
+            if lo < hi:
+                calls.append((i, method, (status, path, lo, hi) + args))
+            offset += count
+        return calls
+
+    def call_select(self, calls, timeout=None):
+        paths = []
+        for _, answer in sorted(self.report(
+                self.fan_out(calls, timeout),
+                [i for i, _, _ in calls]).items()):
+            paths.extend(answer)
+        return paths
+
+    def kill_many(self, status=None, path=None, start=None, stop=None,
+                  grace=None):
+        return self.call_select(
+            self.select_calls('kill_many', status, path, start, stop, grace),
+            self.stop_timeout(grace))
+
+    def pause(self, status=None, path=None, start=None, stop=None):
+        return self.call_select(
+            self.select_calls('pause', status, path, start, stop))
+
+    def resume(self, status=None, path=None, start=None, stop=None):
+        return self.call_select(
+            self.select_calls('resume', status, path, start, stop))
+
+    def get_leaderboard(self, metric, limit=10, descending=True, status=None,
+                        path=None):
+        rows = []
+        for answer in self.report(self.call('get_leaderboard', metric, limit,
+                                            descending, status,
+                                            path)).values():
+            rows.extend(answer)
+        rows.sort(key=lambda row: row[metric], reverse=descending)
+        return rows[:limit]
+
+    def get_stats(self):
+        """
+        Returns the stats of every server that answered, by URI.
+        """
+        return dict((self.servers[i].uri, s) for i, s in
+                    self.report(self.call('get_stats')).items())
+
+class FederatedMirror(object):
+    """
+    A `WorkersMirror` of every server of a `Federation`, merged into one
+    list. A server that does not answer keeps showing what it showed last.
+    """
+    def __init__(self, federation):
+        self.federation = federation
+        self.mirrors = [WorkersMirror(None) for _ in federation.servers]
+        self.experiments = {}
+        self.states = {}
+        self.order = []
+        self.errors = []
+
+    def update(self):
+        results = self.federation.fan_out(
+            [(i, 'get_changes', (m.version,))
+             for i, m in enumerate(self.mirrors)])
+
+        updated = False
+        self.errors = []
+        for server, mirror, result in zip(self.federation.servers,
+                                          self.mirrors, results):
+            if isinstance(result, Exception):
+                self.errors.append(server.uri)
+            elif mirror.apply(result):
+                updated = True
+
+        if updated:
+            # Hashes are only unique per server.
+            self.experiments = {}
+            self.states = {}
+            self.order = []
+            for i, mirror in enumerate(self.mirrors):
+                for h in mirror.order:
+                    key = '%d:%s' % (i, h)
+                    self.experiments[key] = mirror.experiments[h]
+                    self.states[key] = mirror.states[h]
+                    self.order.append(key)
+        return updated
+
+    def get_workers_info(self):
+        return [{'state': self.states[h], 'experiment': self.experiments[h]}
+                for h in self.order]
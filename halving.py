@@ -0,0 +1,91 @@
+import math
+
+class HalvingController(object):
+    """
+    Asynchronous successive halving over the live experiments of `halving`
+    sweeps.
+
+    Whenever a running experiment passes one of its rung iterations, its
+    value of the sweep metric at that iteration is recorded for the rung
+    and compared to the values recorded there by the other points of the
+    same sweep. It is promoted (keeps training) if it ranks within the top
+    `keep` fraction, and is to be stopped otherwise. Until a rung has seen
+    enough points to tell the top fraction apart, everybody is promoted.
+    """
+    def __init__(self):
+        # (group, rung) -> {experiment hash: value}
+        self.rungs = {}
+        # (experiment hash, rung) pairs that have been judged already.
+        self.judged = set()
+
+    def is_promoted(self, value, values, halving):
+        min_points = int(math.ceil(1.0 / halving['keep']))
+        if len(values) < min_points:
+            return True
+
+        ranked = sorted(values, reverse=(halving['mode'] == 'max'))
+        num_kept = max(int(len(ranked) * halving['keep']), 1)
+        threshold = ranked[num_kept - 1]
+
+        if halving['mode'] == 'max':
+            return value >= threshold
+        return value <= threshold
+
+    def rung_value(self, w, metric, rung):
+        """
+        The value of `metric` an experiment logged last at or before the
+        rung iteration, taken from its history, or the first one after if
+        there is none. None if it has logged none yet.
+        """
+        points = w.get_history(metric).get(metric, [])
+        before = [value for iteration, value in points if iteration <= rung]
+        if before:
+            return before[-1]
+        if points:
+            return points[0][1]
+        return None
+
+    def update(self, entries, states):
+        """
+        Judges the experiments that have reached new rungs. Returns the
+        entries that should be stopped. The values of all the experiments
+        that reached a rung since the last call are recorded before any of
+        them is ranked, so the outcome does not depend on their order.
+        """
+        # [entry, halving, rungs reached but not judged, lowest first]
+        pending = []
+        for w, state in zip(entries, states):
+            halving = w.experiment.get('halving')
+            if not halving or state['status'] != 1:
+                continue
+
+            h = w.experiment['hash']
+            rungs = [rung for rung in halving['rungs']
+                     if rung <= state['iter'] and (h, rung) not in self.judged]
+            if rungs:
+                pending.append((w, halving, rungs))
+
+        to_stop = []
+        while pending:
+            reached = []
+            for w, halving, rungs in pending:
+                value = self.rung_value(w, halving['metric'], rungs[0])
+                if value is None:
+                    continue
+
+                h = w.experiment['hash']
+                self.judged.add((h, rungs[0]))
+                values = self.rungs.setdefault((halving['group'], rungs[0]),
+                                               {})
+                values[h] = value
+                reached.append((w, halving, rungs, value))
+
+            pending = []
+            for w, halving, rungs, value in reached:
+                values = self.rungs[(halving['group'], rungs[0])]
+                if not self.is_promoted(value, values.values(), halving):
+                    to_stop.append(w)
+                elif len(rungs) > 1:
+                    pending.append((w, halving, rungs[1:]))
+
+        return to_stop
@@ -0,0 +1,58 @@
+import multiprocessing as mp
+
+class MetricHistory(object):
+    """
+    Per-metric ring buffers of (iteration, value) points in shared memory.
+
+    Every metric owns `size` slots. While a buffer has free slots every
+    point is stored; once it is full, only every `downsample`-th point
+    overwrites the oldest one. The arrays are not synchronized on their own,
+    callers are expected to hold the owner's state lock.
+    """
+    def __init__(self, names, size=1000, downsample=1):
+        self.names = list(names)
+        self.index = dict(zip(self.names, range(len(self.names))))
+        self.size = size
+        self.downsample = max(downsample, 1)
+
+        num_slots = len(self.names) * size
+        self.iters = mp.Array('f', num_slots, lock=False)
+        self.values = mp.Array('f', num_slots, lock=False)
+        # Number of points offered to and actually stored in each buffer.
+        self.seen = mp.Array('i', len(self.names), lock=False)
+        self.stored = mp.Array('i', len(self.names), lock=False)
+
+    def append(self, idx, iteration, value):
+        seen = self.seen[idx]
+        self.seen[idx] = seen + 1
+        if seen >= self.size and (seen - self.size) % self.downsample:
+            return
+
+        stored = self.stored[idx]
+        slot = idx * self.size + stored % self.size
+        self.iters[slot] = iteration
+        self.values[slot] = value
+        self.stored[idx] = stored + 1
+
+    def get(self, name, start=0, stop=None):
+        """
+        Returns the buffered points of a metric, oldest first, as a list of
+        (iteration, value) pairs sliced with `start` and `stop`.
+        """
+        idx = self.index[name]
+        stored = self.stored[idx]
+        base = idx * self.size
+
+        iters = self.iters[base:base + self.size]
+        values = self.values[base:base + self.size]
+        if stored > self.size:
+            # The buffer has wrapped around; rotate it to start at the
+            # oldest point.
+            head = stored % self.size
+            iters = iters[head:] + iters[:head]
+            values = values[head:] + values[:head]
+        else:
+            iters = iters[:stored]
+            values = values[:stored]
+
+        return zip(iters, values)[start:stop]
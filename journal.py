@@ -0,0 +1,66 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+
+from util import write_atomic
+
+class Journal(object):
+    """
+    Append-only record of the experiments the server has launched and not
+    seen finish. Training processes run in sessions of their own and
+    outlive a crashed server; the journal tells the next one which
+    experiments to look for. It is compacted whenever it is opened.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # hash -> {'root_path', 'experiment', 'devices', 'request'}
+        self.records = OrderedDict()
+        self.load()
+        self.compact()
+
+    def load(self):
+        try:
+            f = open(self.path, 'r')
+        except IOError:
+            return
+
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line torn by a crash while appending.
+                    continue
+                if entry['op'] == 'launched':
+                    self.records[entry['hash']] = entry['record']
+                else:
+                    self.records.pop(entry['hash'], None)
+
+    def compact(self):
+        with self.lock:
+            write_atomic(self.path, ''.join(
+                json.dumps({'op': 'launched', 'hash': h, 'record': record}) +
+                '\n' for h, record in self.records.items()))
+
+    def append(self, entry):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def launched(self, root_path, experiment, devices, request):
+        record = {
+            'root_path': os.path.abspath(root_path),
+            'experiment': experiment,
+            'devices': devices,
+            'request': request
+        }
+        h = experiment['hash']
+        with self.lock:
+            self.records[h] = record
+            self.append({'op': 'launched', 'hash': h, 'record': record})
+
+    def done(self, h):
+        with self.lock:
+            if self.records.pop(h, None) is not None:
+                self.append({'op': 'done', 'hash': h})
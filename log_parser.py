@@ -0,0 +1,183 @@
+import re
+
+re_max_iter = re.compile('^max_iter: (\d+)')
+re_iteration = re.compile('Iteration (\d+)')
+re_top_output = re.compile('Iteration \d+, (\w+) = ([\.\d]+(e[+-][\d]+)*)')
+re_output = re.compile('(Test|Train) net output #\d+: '
+                       '(\w+) = ([\.\d]+(e[+-][\d]+)*)')
+re_snapshot = re.compile('Snapshotting (?:solver state )?to '
+                         '(?:binary proto file |HDF5 file )?(\S+)')
+re_snapshot_iter = re.compile('_iter_(\d+)\.')
+
+# All the line kinds we care about folded into a single pattern, so that
+# every candidate line is scanned exactly once.
+re_line = re.compile(
+    'Iteration (?P<iter>\d+)'
+    '(?:, (?P<top_name>\w+) = (?P<top_value>[\.\d]+(?:e[+-][\d]+)*))?'
+    '|(?P<phase>Test|Train) net output #\d+: '
+    '(?P<out_name>\w+) = (?P<out_value>[\.\d]+(?:e[+-][\d]+)*)'
+    '|^max_iter: (?P<max_iter>\d+)'
+    '|Snapshotting (?:solver state )?to '
+    '(?:binary proto file |HDF5 file )?(?P<snapshot>\S+)')
+
+def snapshot_iteration(path, default):
+    m = re_snapshot_iter.search(path)
+    if m is None:
+        return default
+    return float(m.group(1))
+
+
+class RegexLogParser(object):
+    """
+    Reference parser: runs every pattern over every line.
+    """
+    def __init__(self, watch):
+        self.watched_dict = dict(zip(watch, range(len(watch))))
+        self.iteration = 0.0
+        self.max_iteration = 0.0
+        self.watched_values = [0.0] * len(watch)
+        self.updates = []
+        self.outputs = []
+        self.snapshots = []
+
+    def pop_outputs(self):
+        """
+        Returns (name, iteration, value) for every value seen since the
+        previous call, watched or not.
+        """
+        outputs = self.outputs
+        self.outputs = []
+        return outputs
+
+    def pop_updates(self):
+        """
+        Returns (index, iteration, value) for every watched value seen since
+        the previous call.
+        """
+        updates = self.updates
+        self.updates = []
+        return updates
+
+    def pop_snapshots(self):
+        """
+        Returns (iteration, path) for every snapshot file announced since
+        the previous call.
+        """
+        snapshots = self.snapshots
+        self.snapshots = []
+        return snapshots
+
+    def add_snapshot(self, path):
+        iteration = snapshot_iteration(path, self.iteration)
+        # Caffe only logs the iteration at multiples of display or
+        # test_interval, but always snapshots the last one.
+        self.iteration = max(self.iteration, iteration)
+        self.snapshots.append((iteration, path))
+
+    def get_checkpoint(self):
+        return {
+            'iter': self.iteration,
+            'max_iter': self.max_iteration,
+            'watched_values': dict(zip(self.watched_names(),
+                                       self.watched_values))
+        }
+
+    def restore_checkpoint(self, checkpoint):
+        self.iteration = checkpoint['iter']
+        self.max_iteration = checkpoint['max_iter']
+        for name, value in checkpoint['watched_values'].items():
+            idx = self.watched_dict.get(name)
+            if idx is not None:
+                self.watched_values[idx] = value
+
+    def watched_names(self):
+        return sorted(self.watched_dict, key=self.watched_dict.get)
+
+    def set_value(self, value_name, value):
+        self.outputs.append((value_name, self.iteration, value))
+        if value_name in self.watched_dict.keys():
+            idx = self.watched_dict[value_name]
+            self.watched_values[idx] = value
+            self.updates.append((idx, self.iteration, value))
+
+    def feed(self, lines):
+        for line in lines:
+            iteration_match = re_iteration.search(line)
+            if iteration_match:
+                self.iteration = float(iteration_match.group(1))
+
+            max_iter_match = re_max_iter.search(line)
+            if max_iter_match:
+                self.max_iteration = float(max_iter_match.group(1))
+
+            top_output_match = re_top_output.search(line)
+            if top_output_match:
+                value_name = top_output_match.group(1)
+                value = float(top_output_match.group(2))
+                self.set_value(value_name, value)
+
+            output_match = re_output.search(line)
+            if output_match:
+                value_name = output_match.group(1).lower()
+                value_name += '_' + output_match.group(2)
+                value = float(output_match.group(3))
+                self.set_value(value_name, value)
+
+            snapshot_match = re_snapshot.search(line)
+            if snapshot_match:
+                self.add_snapshot(snapshot_match.group(1))
+
+
+class LogParser(RegexLogParser):
+    """
+    Single-pass parser: a literal prefilter rejects the bulk of the log
+    before any regex runs, and the remaining lines are classified by one
+    combined pattern.
+    """
+    def set_value(self, value_name, value):
+        self.outputs.append((value_name, self.iteration, value))
+        idx = self.watched_dict.get(value_name)
+        if idx is not None:
+            self.watched_values[idx] = value
+            self.updates.append((idx, self.iteration, value))
+
+    def feed(self, lines):
+        search = re_line.search
+        for line in lines:
+            if ('Iteration' not in line and 'net output' not in line and
+                    not line.startswith('max_iter') and
+                    'Snapshotting' not in line):
+                continue
+
+            m = search(line)
+            if m is None:
+                continue
+
+            iteration, top_name, top_value, phase, out_name, out_value, \
+                max_iteration, snapshot = m.group(
+                    'iter', 'top_name', 'top_value', 'phase', 'out_name',
+                    'out_value', 'max_iter', 'snapshot')
+
+            if iteration is not None:
+                self.iteration = float(iteration)
+                if top_name is not None:
+                    self.set_value(top_name, float(top_value))
+            elif out_name is not None:
+                self.set_value(phase.lower() + '_' + out_name,
+                               float(out_value))
+            elif max_iteration is not None:
+                self.max_iteration = float(max_iteration)
+            else:
+                self.add_snapshot(snapshot)
+
+
+PARSERS = {
+    'regex': RegexLogParser,
+    'fast': LogParser
+}
+
+def make_parser(name, watch):
+    try:
+        return PARSERS[name](watch)
+    except KeyError:
+        raise NotImplementedError('Unknown log parser: %s' % name)
@@ -0,0 +1,263 @@
+import os
+import sys
+import errno
+import fcntl
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+
+LOG_EVENTS = IN_CREATE | IN_MODIFY | IN_MOVED_TO | IN_CLOSE_WRITE
+
+# Signals that should interrupt a blocked watcher: termination of the
+# training process and shutdown requests coming from the server.
+WAKEUP_SIGNALS = (signal.SIGCHLD, signal.SIGUSR1)
+
+inotify_event = struct.Struct('iIII')
+
+def load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+libc = load_libc()
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def drain(fd):
+    data = []
+    while True:
+        try:
+            chunk = os.read(fd, 4096)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                break
+            raise
+        if not chunk:
+            break
+        data.append(chunk)
+    return ''.join(data)
+
+
+class PollingLogWatcher(object):
+    """
+    Wakes up on a timer or when the server notifies `control_cond`.
+    """
+    wakes_on_signal = False
+
+    def __init__(self, log_path, control_cond, interval=5):
+        self.log_path = log_path
+        self.control_cond = control_cond
+        self.interval = interval
+
+    def wait(self):
+        # Keep checking for the log every second until it appears.
+        if os.path.exists(self.log_path):
+            interval = self.interval
+        else:
+            interval = 1
+
+        with self.control_cond:
+            self.control_cond.wait(interval)
+
+    def close(self):
+        pass
+
+
+class Inotify(object):
+    """
+    Thin wrapper around an inotify instance.
+    """
+    def __init__(self):
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def add_watch(self, path, mask):
+        # ctypes would pass a unicode path as a wide string.
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return wd
+
+    def remove_watch(self, wd):
+        libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """
+        Returns (wd, mask, name) for every pending event.
+        """
+        data = drain(self.fd)
+        events = []
+        offset = 0
+        while offset + inotify_event.size <= len(data):
+            wd, mask, _, length = inotify_event.unpack_from(data, offset)
+            offset += inotify_event.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class InotifyLogWatcher(object):
+    """
+    Sleeps until the log is created or written to, the training process
+    exits or the server delivers a shutdown signal. Linux only.
+    """
+    wakes_on_signal = True
+
+    def __init__(self, log_path, inotify):
+        self.log_name = os.path.basename(log_path)
+
+        # Watch the directory rather than the file itself, so that we are
+        # also notified when the log gets created.
+        self.inotify = inotify
+        self.inotify.add_watch(os.path.dirname(log_path), LOG_EVENTS)
+
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        set_nonblocking(self.wakeup_r)
+        set_nonblocking(self.wakeup_w)
+
+        self.old_handlers = {}
+        for sig in WAKEUP_SIGNALS:
+            self.old_handlers[sig] = signal.signal(sig, lambda *args: None)
+            signal.siginterrupt(sig, False)
+        self.old_wakeup_fd = signal.set_wakeup_fd(self.wakeup_w)
+
+    def wait(self):
+        while True:
+            try:
+                readable, _, _ = select.select(
+                    [self.inotify.fd, self.wakeup_r], [], [])
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if self.wakeup_r in readable:
+                drain(self.wakeup_r)
+                return
+
+            for _, _, name in self.inotify.read_events():
+                if name == self.log_name:
+                    return
+
+    def close(self):
+        signal.set_wakeup_fd(self.old_wakeup_fd)
+        for sig, handler in self.old_handlers.items():
+            signal.signal(sig, handler)
+        self.inotify.close()
+        for fd in [self.wakeup_r, self.wakeup_w]:
+            os.close(fd)
+
+
+class ChunkedLogReader(object):
+    """
+    Hands out complete lines of a growing log, reading at most
+    `chunk_size` bytes per call. A trailing partial line is held back until
+    its newline arrives; a single line longer than `chunk_size` is dropped
+    so that memory stays bounded by roughly twice the chunk size.
+    """
+    def __init__(self, log_file, chunk_size=1 << 20, offset=0):
+        self.log_file = log_file
+        self.chunk_size = chunk_size
+        # Number of bytes handed out (or dropped) so far. Everything before
+        # it is done with; `partial` starts right at it.
+        self.offset = offset
+        self.partial = ''
+        self.discarding = False
+
+    def read_lines(self):
+        while True:
+            self.log_file.seek(self.offset + len(self.partial))
+            chunk = self.log_file.read(self.chunk_size)
+            if not chunk:
+                return []
+
+            data = self.partial + chunk
+            end = data.rfind('\n') + 1
+
+            if end == 0:
+                self.partial = data
+                if len(self.partial) > self.chunk_size:
+                    self.offset += len(self.partial)
+                    self.partial = ''
+                    self.discarding = True
+            else:
+                self.partial = data[end:]
+                lines = data[:end].splitlines(True)
+                self.offset += end
+
+                if self.discarding:
+                    # Tail of an overly long line we have already given
+                    # up on.
+                    lines = lines[1:]
+                    self.discarding = False
+
+                if lines:
+                    return lines
+
+            # Only report an empty batch once the end of the log is hit.
+            if len(chunk) < self.chunk_size:
+                return []
+
+    def lag(self):
+        """
+        Number of bytes between the parsed position and the end of the log.
+        """
+        return max(os.fstat(self.log_file.fileno()).st_size - self.offset, 0)
+
+
+def make_inotify(mode):
+    """
+    Returns an Inotify instance, or None if polling should be used instead.
+    """
+    if mode not in ['auto', 'inotify', 'poll']:
+        raise NotImplementedError('Unknown tail mode: %s' % mode)
+
+    if mode == 'poll':
+        return None
+
+    try:
+        if libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        return Inotify()
+    except OSError:
+        if mode == 'inotify':
+            raise
+        return None
+
+def make_log_watcher(mode, log_path, control_cond):
+    inotify = make_inotify(mode)
+    if inotify is not None:
+        try:
+            return InotifyLogWatcher(log_path, inotify)
+        except OSError:
+            inotify.close()
+            if mode == 'inotify':
+                raise
+
+    return PollingLogWatcher(log_path, control_cond)
@@ -0,0 +1,146 @@
+from __future__ import print_function
+
+import os
+import mmap
+import array
+import struct
+import argparse
+
+# Every metric lives in its own append-only file of fixed-width
+# (iteration, value) records, so reading a range of points is a slice of a
+# memory map.
+RECORD = struct.Struct('<dd')
+SUFFIX = '.bin'
+
+def metric_path(path, name):
+    return os.path.join(path, name + SUFFIX)
+
+
+class MetricsWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def get_file(self, name):
+        f = self.files.get(name)
+        if f is None:
+            f = open(metric_path(self.path, name), 'ab')
+            self.files[name] = f
+        return f
+
+    def append(self, outputs):
+        for name, iteration, value in outputs:
+            self.get_file(name).write(RECORD.pack(iteration, value))
+        self.flush()
+
+    def counts(self):
+        """
+        Number of records per metric, as seen on disk.
+        """
+        self.flush()
+        return dict((name[:-len(SUFFIX)],
+                     os.path.getsize(os.path.join(self.path, name)) //
+                     RECORD.size)
+                    for name in os.listdir(self.path)
+                    if name.endswith(SUFFIX))
+
+    def truncate(self, counts):
+        """
+        Rolls the store back to the given number of records per metric.
+        Metrics that are not mentioned are dropped completely.
+        """
+        self.close()
+        for name in os.listdir(self.path):
+            if not name.endswith(SUFFIX):
+                continue
+            count = counts.get(name[:-len(SUFFIX)], 0)
+            with open(os.path.join(self.path, name), 'r+b') as f:
+                f.truncate(count * RECORD.size)
+
+    def flush(self):
+        for f in self.files.values():
+            f.flush()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+class MetricsReader(object):
+    def __init__(self, path):
+        self.path = path
+
+    def names(self):
+        if not os.path.exists(self.path):
+            return []
+        return sorted(name[:-len(SUFFIX)] for name in os.listdir(self.path)
+                      if name.endswith(SUFFIX))
+
+    def read(self, name, start=0, stop=None):
+        """
+        Returns records [start:stop) of a metric as a list of
+        (iteration, value) pairs.
+        """
+        try:
+            f = open(metric_path(self.path, name), 'rb')
+        except IOError:
+            return []
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            num_records = size // RECORD.size
+            start, stop, _ = slice(start, stop).indices(num_records)
+            if start >= stop:
+                return []
+
+            mm = mmap.mmap(f.fileno(), num_records * RECORD.size,
+                           access=mmap.ACCESS_READ)
+            try:
+                data = array.array('d', mm[start * RECORD.size:
+                                           stop * RECORD.size])
+            finally:
+                mm.close()
+
+        return zip(data[0::2], data[1::2])
+
+    def read_all(self, names=None, start=0, stop=None):
+        if names is None:
+            names = self.names()
+        return dict((name, self.read(name, start, stop)) for name in names)
+
+
+def plot(metrics, output_path):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    for name, points in sorted(metrics.items()):
+        if points:
+            iters, values = zip(*points)
+            plt.plot(iters, values, label=name)
+    plt.xlabel('Iteration')
+    plt.legend(loc='best')
+    plt.savefig(output_path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Dumps or plots the metrics recorded for an experiment.')
+    parser.add_argument('path', help='metrics directory of the experiment')
+    parser.add_argument('names', nargs='*',
+                        help='metrics to show (default: all)')
+    parser.add_argument('-o', '--output', default='',
+                        help='plot into the given image instead of printing')
+
+    args = parser.parse_args()
+
+    metrics = MetricsReader(args.path).read_all(args.names or None)
+
+    if args.output:
+        plot(metrics, args.output)
+    else:
+        for name, points in sorted(metrics.items()):
+            for iteration, value in points:
+                print('{},{:g},{:g}'.format(name, iteration, value))
@@ -0,0 +1,285 @@
+import time
+import curses
+
+from query import STATUS_CODES
+
+STATUS_NAMES = dict((code, name) for name, code in STATUS_CODES.items())
+
+HEADER = {
+    'idx': 'ID',
+    'status': 'STATUS',
+    'path': 'PATH',
+    'desc': 'DESCRIPTION',
+    'progress': 'ITER / MAX_ITER',
+    'value_name': 'NAME',
+    'value': 'VALUE'
+}
+
+FIELDS_ORDER = ['idx', 'status', 'path', 'desc', 'progress', 'value_name',
+                'value']
+
+# Statuses cycled through by the filter key, None showing all of them.
+FILTERS = [None, 0, 1, 3, 2, 4]
+
+# Screen rows taken by the border, the title and the header.
+TOP_MARGIN = 4
+BOTTOM_MARGIN = 1
+
+def get_fields(w):
+    """
+    Returns the display lines of an experiment, one per watched value. The
+    ID is left blank since it depends on the position in the list.
+    """
+    value_names = w['experiment']['watch']
+    values = w['state']['watched_values']
+
+    ds = []
+
+    num_values = len(value_names)
+
+    for line_idx in xrange(max(num_values, 1)):
+        if num_values == 0:
+            value_name = ''
+            value = ''
+        else:
+            value_name = value_names[line_idx]
+            value = str(values[line_idx])
+
+        d = {
+            'idx': '',
+            'status': '',
+            'path': '',
+            'desc': '',
+            'progress': '',
+            'value_name': value_name,
+            'value': value
+        }
+
+        if line_idx > 0:
+            ds.append(d)
+            continue
+
+        iteration = int(w['state']['iter'])
+        max_iteration = int(w['state']['max_iter'])
+
+        d.update({
+            'status': STATUS_NAMES[w['state']['status']],
+            'path': w['experiment']['path'],
+            'desc': w['experiment']['description'],
+            'progress': '{:d} / {:d}'.format(iteration, max_iteration)
+        })
+
+        ds.append(d)
+
+    return ds
+
+class WorkersMirror(object):
+    """
+    Client side copy of the server's experiment list, kept up to date with
+    the changes since the last poll.
+    """
+    def __init__(self, automator_server):
+        self.automator_server = automator_server
+        self.version = 0
+        self.experiments = {}
+        self.states = {}
+        self.order = []
+        # Servers that did not answer the last poll.
+        self.errors = []
+
+    def update(self):
+        """
+        Fetches the changes since the last poll. Returns whether there
+        were any.
+        """
+        return self.apply(self.automator_server.get_changes(self.version))
+
+    def apply(self, changes):
+        if changes['reset']:
+            self.experiments = {}
+            self.states = {}
+        for h in changes['removed']:
+            self.experiments.pop(h, None)
+            self.states.pop(h, None)
+        self.experiments.update(changes['added'])
+        self.states.update(changes['changed'])
+        if 'order' in changes:
+            self.order = changes['order']
+
+        updated = changes['version'] != self.version
+        self.version = changes['version']
+        return updated
+
+    def get_workers_info(self):
+        return [{'state': self.states[h], 'experiment': self.experiments[h]}
+                for h in self.order]
+
+class Monitor(object):
+    """
+    Curses view of a `WorkersMirror`. Only the rows that fit on the screen
+    are formatted, and only the screen lines whose text changed since the
+    last draw are written, so a long list costs little to follow over a
+    slow terminal. Column widths only ever grow, so rows do not shift
+    around as values change.
+    """
+    def __init__(self, stdscr, mirror):
+        self.stdscr = stdscr
+        self.mirror = mirror
+        self.top = 0
+        self.filter_idx = 0
+        # hash -> (state, lines) of the experiments last shown
+        self.fields = {}
+        # (experiment index, line) for every line that passes the filter
+        self.rows = []
+        self.widths = dict((k, len(v)) for k, v in HEADER.items())
+        # screen row -> (text, attr) as last written
+        self.drawn = {}
+
+    def poll(self):
+        if self.mirror.update():
+            self.update_rows()
+
+    def update_rows(self):
+        status = FILTERS[self.filter_idx]
+
+        fields = {}
+        rows = []
+        for i, h in enumerate(self.mirror.order):
+            state = self.mirror.states[h]
+            if status is not None and state['status'] != status:
+                continue
+
+            # The mirror replaces the state of an experiment that changed,
+            # so an identical one means the lines can be reused.
+            cached = self.fields.get(h)
+            if cached is None or cached[0] is not state:
+                lines = get_fields({'state': state,
+                                    'experiment': self.mirror.experiments[h]})
+                lines[0]['idx'] = str(i)
+                for line in lines:
+                    for k, v in line.items():
+                        if len(v) > self.widths[k]:
+                            self.widths[k] = len(v)
+                cached = (state, lines)
+            elif cached[1][0]['idx'] != str(i):
+                cached[1][0]['idx'] = str(i)
+                self.widths['idx'] = max(self.widths['idx'], len(str(i)))
+
+            fields[h] = cached
+            rows.extend((i, line) for line in cached[1])
+
+        self.fields = fields
+        self.rows = rows
+
+    def page_height(self):
+        height, _ = self.stdscr.getmaxyx()
+        return max(height - TOP_MARGIN - BOTTOM_MARGIN, 0)
+
+    def put(self, y, text, attr, width):
+        text = text[:width].ljust(width)
+        if self.drawn.get(y) != (text, attr):
+            self.stdscr.addstr(y, 2, text, attr)
+            self.drawn[y] = (text, attr)
+
+    def draw(self):
+        _, width = self.stdscr.getmaxyx()
+        width = max(width - 4, 0)
+        page = self.page_height()
+
+        self.top = max(min(self.top, len(self.rows) - page), 0)
+        visible = self.rows[self.top:self.top + page]
+
+        status = FILTERS[self.filter_idx]
+        title = 'List of experiments'
+        if status is not None:
+            title += ' (%s)' % STATUS_NAMES[status]
+        if self.rows:
+            title += ': lines %d-%d of %d' % (
+                self.top + 1, self.top + len(visible), len(self.rows))
+        if self.mirror.errors:
+            title += ' [not answering: %s]' % ', '.join(self.mirror.errors)
+        self.put(1, title, 0, width)
+
+        format_s = '  '.join('{%s:<%d}' % (k, self.widths[k])
+                             for k in FIELDS_ORDER)
+        self.put(3, format_s.format(**HEADER), curses.A_BOLD, width)
+
+        for y in xrange(page):
+            if y < len(visible):
+                i, line = visible[y]
+                self.put(TOP_MARGIN + y, format_s.format(**line),
+                         curses.color_pair(i % 2), width)
+            else:
+                self.put(TOP_MARGIN + y, '', 0, width)
+
+        self.stdscr.refresh()
+
+    def redraw(self):
+        self.stdscr.erase()
+        self.stdscr.border()
+        self.drawn = {}
+
+    def handle_key(self, c):
+        """
+        Scrolls, pages or changes the filter. Returns False on quit.
+        """
+        page = max(self.page_height() - 1, 1)
+
+        if c in (ord('q'), 27):
+            return False
+        elif c in (curses.KEY_DOWN, ord('j')):
+            self.top += 1
+        elif c in (curses.KEY_UP, ord('k')):
+            self.top -= 1
+        elif c in (curses.KEY_NPAGE, ord(' ')):
+            self.top += page
+        elif c == curses.KEY_PPAGE:
+            self.top -= page
+        elif c in (curses.KEY_HOME, ord('g')):
+            self.top = 0
+        elif c in (curses.KEY_END, ord('G')):
+            self.top = len(self.rows)
+        elif c == ord('f'):
+            self.filter_idx = (self.filter_idx + 1) % len(FILTERS)
+            self.top = 0
+            self.update_rows()
+        elif c == curses.KEY_RESIZE:
+            self.redraw()
+
+        return True
+
+def display_info(stdscr, mirror, interval):
+    """
+    Shows the experiments of `mirror`, polling it every `interval`
+    seconds, or only once if it is 0. Arrows, j/k, PgUp/PgDn, space and
+    g/G scroll, f cycles the status filter and q quits.
+    """
+    curses.curs_set(0)
+    curses.start_color()
+
+    curses.init_pair(1, curses.COLOR_BLUE, curses.COLOR_BLACK)
+
+    if interval < 0:
+        interval = 0
+
+    monitor = Monitor(stdscr, mirror)
+    monitor.redraw()
+    monitor.poll()
+    last_poll = time.time()
+
+    while True:
+        monitor.draw()
+
+        if interval == 0:
+            stdscr.timeout(-1)
+        else:
+            remaining = last_poll + interval - time.time()
+            stdscr.timeout(max(int(remaining * 1000), 0))
+
+        c = stdscr.getch()
+        if c != -1 and not monitor.handle_key(c):
+            break
+
+        if interval > 0 and time.time() - last_poll >= interval:
+            monitor.poll()
+            last_poll = time.time()
@@ -1,86 +1,236 @@
-from copy import deepcopy
-from itertools import product
+import os
+import json
+import hashlib
+import operator
+import yaml
+from itertools import product, izip
 from string import Template
 
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
 EXPERIMENT_BASE_DEFAULTS = {
     'unroll': 'zip',
     'weights': '',
     'model': {'values': {}},
     'solver': {'values': {}},
     'watch': [],
-    'command': None
+    'command': None,
+    'parser': 'fast',
+    'tail': 'auto',
+    'history': {'size': 1000, 'downsample': 1},
+    'gpus': 1,
+    'priority': 0,
+    'snapshots': {'keep_last': 0, 'keep_best': 0, 'metric': '', 'mode': 'max'},
+    'branch': {'at': 0, 'values': []}
+}
+
+# Where the trunks of branching sweeps go, relative to the root path.
+TRUNKS_PATH = 'trunks'
+
+HALVING_DEFAULTS = {
+    'metric': '',
+    'mode': 'max',
+    'rungs': [],
+    'keep': 0.5
 }
 
+# path -> ((mtime, size), (root_path, sweeps))
+sweep_cache = {}
+
 def merge_dicts(*args):
-    def merge(a, b, path=[]):
-        for key in b:
-            if key in a:
-                if isinstance(a[key], dict) and isinstance(b[key], dict):
-                    merge(a[key], b[key], path + [str(key)])
-                elif a[key] != b[key]:
-                    a[key] = b[key]
+    """
+    Merges nested dicts, later ones taking precedence, into a new one. The
+    arguments are left untouched and whatever is not merged is shared with
+    them rather than copied.
+    """
+    def merge(a, b):
+        merged = dict(a)
+        for key, value in b.items():
+            if isinstance(merged.get(key), dict) and isinstance(value, dict):
+                merged[key] = merge(merged[key], value)
             else:
-                if isinstance(b[key], dict):
-                    a[key] = deepcopy(b[key])
-                else:
-                    a[key] = b[key]
-        return a
+                merged[key] = value
+        return merged
     return reduce(merge, args, {})
 
-def preprocess_experiments(data):
-    experiments = deepcopy(data['experiments'])
-    defaults = data['defaults']
+def load_sweeps(path):
+    """
+    Loads a sweep file and returns its root path and preprocessed entries.
+    The result is kept until the file changes.
+    """
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    key = (st.st_mtime, st.st_size)
+
+    cached = sweep_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    with open(path, 'r') as f:
+        data = yaml.load(f, Loader=Loader)
+    result = (data['root_path'], preprocess_sweeps(data))
 
-    fill_defaults(experiments, defaults)
-    experiments = unroll_values(experiments)
+    sweep_cache[path] = (key, result)
+    return result
+
+def preprocess_sweeps(data):
+    """
+    Fills in the defaults of every experiment entry, without unrolling.
+    """
+    experiments = fill_defaults(data['experiments'], data['defaults'])
+    for e in experiments:
+        check_snapshots(e)
+        if e['unroll'] == 'halving':
+            prepare_halving(e)
+        if e['branch']['at'] > 0:
+            check_branch(e)
 
     return experiments
 
 def fill_defaults(experiments, defaults):
-    for i in xrange(len(experiments)):
-        experiments[i] = merge_dicts(EXPERIMENT_BASE_DEFAULTS, defaults, experiments[i])
-
-def unroll_values(experiments):
-    def get_path_template_dict(d):
-        path_template_d = {}
-        for k1 in ['model', 'solver']:
-            for k2, v in d[k1]['values'].items():
-                if isinstance(v, float):
-                    v = '{:g}'.format(v)
-                path_template_d[k1 + '_' + k2] = v
-        return path_template_d
-
-    unrolled_experiments = []
-    for e in experiments:
-        mode = e['unroll']
-        if mode == 'product':
-            generator = product
-        elif mode == 'zip':
-            generator = zip
-        else:
-            raise NotImplementedError()
-
-        to_unroll = []
-        for k1 in ['model', 'solver']:
-            to_unroll.extend([(k1, k2, e[k1]['values'][k2]) 
-                              for k2 in e[k1]['values'].keys() 
-                              if isinstance(e[k1]['values'][k2], list)])
-
-        if len(to_unroll) == 0:
-            path_template_d = get_path_template_dict(e)
-            e['path'] = Template(e['path']).substitute(path_template_d)
-            unrolled_experiments.append(e)
-            continue
-
-        for t in generator(*[x[2] for x in to_unroll]):
-            flat_e = deepcopy(e)
-            for i, v in enumerate(t):
-                k1 = to_unroll[i][0]
-                k2 = to_unroll[i][1]
-                flat_e[k1]['values'][k2] = v
-
-            path_template_d = get_path_template_dict(flat_e)
-            flat_e['path'] = Template(flat_e['path']).substitute(path_template_d)
-            unrolled_experiments.append(flat_e)
-
-    return unrolled_experiments
+    base = merge_dicts(EXPERIMENT_BASE_DEFAULTS, defaults)
+    return [merge_dicts(base, e) for e in experiments]
+
+def check_snapshots(e):
+    policy = e['snapshots']
+    if policy['keep_best'] > 0 and not policy['metric']:
+        raise ValueError('Keeping the best snapshots of %s needs a metric' %
+                         e['path'])
+    if policy['mode'] not in ['min', 'max']:
+        raise ValueError('Snapshot mode has to be "min" or "max"')
+
+def prepare_halving(e):
+    """
+    Validates the successive halving settings of a sweep and makes sure the
+    metric it ranks by is watched.
+    """
+    halving = merge_dicts(HALVING_DEFAULTS, e.get('halving', {}))
+    if not halving['metric']:
+        raise ValueError('Halving sweep %s needs a metric' % e['path'])
+    if halving['mode'] not in ['min', 'max']:
+        raise ValueError('Halving mode has to be "min" or "max"')
+    if not 0 < halving['keep'] < 1:
+        raise ValueError('Halving keep fraction has to be in (0, 1)')
+
+    halving['rungs'] = sorted(halving['rungs'])
+    # All points of one sweep are ranked against each other.
+    halving['group'] = e['path']
+    e['halving'] = halving
+
+    if halving['metric'] not in e['watch']:
+        e['watch'] = e['watch'] + [halving['metric']]
+
+def check_branch(e):
+    branch = e['branch']
+    if e['command']:
+        raise ValueError('Branching sweep %s cannot use a custom command, '
+                         'it has to resume from snapshots' % e['path'])
+    if e['unroll'] == 'halving':
+        raise ValueError('Sweep %s cannot both halve and branch' % e['path'])
+    unknown = [k for k in branch['values'] if k not in e['solver']['values']]
+    if unknown:
+        raise ValueError('Branch values of %s are no solver values: %s' %
+                         (e['path'], ', '.join(unknown)))
+
+    # The trunks train with the smallest of every branch value, whichever
+    # points are left to run, so that they render the same every time.
+    trunk_values = {}
+    for k in branch['values']:
+        v = e['solver']['values'][k]
+        trunk_values[k] = min(v) if isinstance(v, list) else v
+    e['branch'] = dict(branch, trunk_values=trunk_values)
+
+def make_trunk(e):
+    """
+    Returns the trunk that a point of a branching sweep forks from: the
+    point trained only up to the branch iteration, with the branch values
+    picked by `check_branch`. The branch values only matter after that, so
+    points that differ in nothing else share the trunk.
+    """
+    branch = e['branch']
+    solver_values = dict(e['solver']['values'])
+    solver_values.update(branch['trunk_values'])
+    key = hashlib.sha1(json.dumps(
+        [e['model'], e['solver']['template'], solver_values, e['weights'],
+         branch['at']], sort_keys=True)).hexdigest()
+
+    trunk = copy_point(e)
+    trunk['solver']['values'] = solver_values
+    trunk['path'] = os.path.join(TRUNKS_PATH, key[:16])
+    trunk['description'] = 'trunk up to iteration %d' % branch['at']
+    trunk['max_iter'] = branch['at']
+    # The last snapshot is what the branches resume from.
+    trunk['snapshots'] = EXPERIMENT_BASE_DEFAULTS['snapshots']
+    trunk['branch'] = EXPERIMENT_BASE_DEFAULTS['branch']
+    return trunk
+
+def get_path_template_dict(d):
+    path_template_d = {}
+    for k1 in ['model', 'solver']:
+        for k2, v in d[k1]['values'].items():
+            if isinstance(v, float):
+                v = '{:g}'.format(v)
+            path_template_d[k1 + '_' + k2] = v
+    return path_template_d
+
+def get_unrolled_values(e):
+    to_unroll = []
+    for k1 in ['model', 'solver']:
+        to_unroll.extend([(k1, k2, e[k1]['values'][k2]) 
+                          for k2 in e[k1]['values'].keys() 
+                          if isinstance(e[k1]['values'][k2], list)])
+    return to_unroll
+
+def copy_point(e):
+    """
+    Copies the parts of an experiment that differ between sweep points and
+    shares everything else.
+    """
+    flat_e = dict(e)
+    for k1 in ['model', 'solver']:
+        flat_e[k1] = dict(e[k1])
+        flat_e[k1]['values'] = dict(e[k1]['values'])
+    return flat_e
+
+def count_unrolled(e):
+    lengths = [len(x[2]) for x in get_unrolled_values(e)]
+    if len(lengths) == 0:
+        return 1
+    if e['unroll'] == 'zip':
+        return min(lengths)
+    return reduce(operator.mul, lengths, 1)
+
+def iter_unrolled(e):
+    """
+    Lazily yields the points of a single experiment entry.
+    """
+    mode = e['unroll']
+    if mode in ['product', 'halving']:
+        generator = product
+    elif mode == 'zip':
+        generator = izip
+    else:
+        raise NotImplementedError()
+
+    to_unroll = get_unrolled_values(e)
+
+    if len(to_unroll) == 0:
+        flat_e = copy_point(e)
+        flat_e['path'] = Template(e['path']).substitute(
+            get_path_template_dict(flat_e))
+        yield flat_e
+        return
+
+    for t in generator(*[x[2] for x in to_unroll]):
+        flat_e = copy_point(e)
+        for i, v in enumerate(t):
+            k1 = to_unroll[i][0]
+            k2 = to_unroll[i][1]
+            flat_e[k1]['values'][k2] = v
+
+        path_template_d = get_path_template_dict(flat_e)
+        flat_e['path'] = Template(flat_e['path']).substitute(path_template_d)
+        yield flat_e
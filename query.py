@@ -0,0 +1,132 @@
+import bisect
+import fnmatch
+import operator
+
+STATUS_CODES = {'WAITING': 0, 'RUNNING': 1, 'FINISHED': 2, 'PAUSED': 3,
+                'HALTED': 4}
+
+OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne
+}
+
+def status_code(status):
+    if isinstance(status, basestring):
+        try:
+            return STATUS_CODES[status.upper()]
+        except KeyError:
+            raise ValueError('Unknown status: %s' % status)
+    return status
+
+class ExperimentIndex(object):
+    """
+    Flattened rows of the experiments known to the server, with indexes by
+    status and by every watched value that are updated along with the
+    rows, so that filtered and sorted queries do not need a scan.
+    """
+    def __init__(self):
+        # hash -> row
+        self.rows = {}
+        # status -> set of hashes
+        self.by_status = {}
+        # value name -> sorted list of (value, hash)
+        self.by_value = {}
+
+    def update(self, h, experiment, state):
+        self.remove(h)
+
+        values = dict(zip(experiment['watch'], state['watched_values']))
+        row = {
+            'hash': h,
+            'path': experiment['path'],
+            'description': experiment.get('description', ''),
+            'status': state['status'],
+            'iter': state['iter'],
+            'max_iter': state['max_iter'],
+            'values': values
+        }
+        self.rows[h] = row
+
+        self.by_status.setdefault(row['status'], set()).add(h)
+        for name, value in values.items():
+            bisect.insort(self.by_value.setdefault(name, []), (value, h))
+
+    def remove(self, h):
+        row = self.rows.pop(h, None)
+        if row is None:
+            return
+
+        self.by_status[row['status']].discard(h)
+        for name, value in row['values'].items():
+            keys = self.by_value[name]
+            del keys[bisect.bisect_left(keys, (value, h))]
+
+    def query(self, status=None, path=None, where=None, sort=None,
+              descending=True, limit=0, fields=None):
+        """
+        Returns the rows that have one of the given statuses, a path
+        matching the `path` glob and watched values passing every
+        (name, operator, threshold) of `where`. They are sorted by the
+        watched value `sort` and cut to `limit` rows, if given. `fields`
+        projects every row to the given keys; watched values can be asked
+        for by name.
+        """
+        if isinstance(status, (basestring, int)):
+            status = [status]
+        statuses = None
+        if status is not None:
+            statuses = set(status_code(s) for s in status)
+
+        conditions = []
+        for name, op, threshold in where or []:
+            if op not in OPERATORS:
+                raise ValueError('Unknown operator: %s' % op)
+            conditions.append((name, OPERATORS[op], threshold))
+
+        def matches(row):
+            if statuses is not None and row['status'] not in statuses:
+                return False
+            if path is not None and not fnmatch.fnmatchcase(row['path'],
+                                                            path):
+                return False
+            for name, compare, threshold in conditions:
+                value = row['values'].get(name)
+                if value is None or not compare(value, threshold):
+                    return False
+            return True
+
+        if sort is not None:
+            keys = self.by_value.get(sort, [])
+            if descending:
+                keys = reversed(keys)
+            candidates = (h for _, h in keys)
+        elif statuses is not None:
+            candidates = (h for s in sorted(statuses)
+                          for h in self.by_status.get(s, ()))
+        else:
+            candidates = iter(self.rows)
+
+        rows = []
+        for h in candidates:
+            row = self.rows[h]
+            if matches(row):
+                rows.append(row)
+                if limit > 0 and len(rows) >= limit:
+                    break
+
+        if fields is not None:
+            rows = [project(row, fields) for row in rows]
+        return rows
+
+def project(row, fields):
+    projected = {}
+    for field in fields:
+        if field in row:
+            projected[field] = row[field]
+        else:
+            projected[field] = row['values'].get(field)
+    return projected
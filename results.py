@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+INDEX_NAME = 'completed.jsonl'
+# Status of the experiments that successive halving stopped.
+HALTED = 4
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS experiments (
+        hash TEXT PRIMARY KEY,
+        root_path TEXT,
+        path TEXT,
+        status INTEGER,
+        iter REAL,
+        max_iter REAL,
+        updated REAL,
+        experiment TEXT,
+        state TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS metrics (
+        hash TEXT,
+        name TEXT,
+        value REAL,
+        PRIMARY KEY (hash, name)
+    )''',
+    'CREATE INDEX IF NOT EXISTS metrics_by_value ON metrics (name, value)',
+    'CREATE INDEX IF NOT EXISTS experiments_by_update ON experiments (updated)'
+]
+
+def is_completed(state):
+    """
+    Whether an experiment trained all the way to its last iteration or was
+    halted for good by successive halving, as opposed to being stopped
+    early otherwise or not run at all.
+    """
+    if state['status'] == HALTED:
+        return True
+    return (state['status'] == 2 and state['max_iter'] > 0 and
+            state['iter'] >= state['max_iter'])
+
+def make_result(experiment, state):
+    return {
+        'hash': experiment['hash'],
+        'path': experiment['path'],
+        'iter': state['iter'],
+        'watched_values': dict(zip(experiment['watch'],
+                                   state['watched_values'])),
+        'time': time.time()
+    }
+
+
+class CompletedIndex(object):
+    """
+    On-disk index of the completed experiments under one root path, keyed
+    by experiment hash. Results are appended one JSON line each, so
+    recording a batch never rewrites the ones recorded before.
+    """
+    def __init__(self, root_path):
+        self.path = os.path.join(root_path, INDEX_NAME)
+        self.results = {}
+        self.load()
+
+    def load(self):
+        try:
+            f = open(self.path, 'r')
+        except IOError:
+            return
+
+        with f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # A line torn by a crash while appending.
+                    continue
+                self.results[result['hash']] = result
+
+    def __contains__(self, h):
+        return h in self.results
+
+    def __len__(self):
+        return len(self.results)
+
+    def get(self, h):
+        return self.results.get(h)
+
+    def add(self, results):
+        if not results:
+            return
+
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(self.path, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+                self.results[result['hash']] = result
+
+
+class ResultsDB(object):
+    """
+    SQLite store of the last known state of every experiment that has run,
+    with one row per watched value for leaderboards. `record` only queues
+    a state; `flush` writes everything queued in one transaction.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    def record(self, root_path, experiment, state):
+        with self.lock:
+            self.pending[experiment['hash']] = (root_path, experiment, state)
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            if not pending:
+                return
+
+            now = time.time()
+            rows = []
+            metrics = []
+            for h, (root_path, experiment, state) in pending.items():
+                rows.append((h, root_path, experiment['path'],
+                             state['status'], state['iter'],
+                             state['max_iter'], now, json.dumps(experiment),
+                             json.dumps(state)))
+                metrics.extend((h, name, value) for name, value in
+                               zip(experiment['watch'],
+                                   state['watched_values']))
+
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO experiments VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO metrics VALUES (?, ?, ?)',
+                    metrics)
+
+    def leaderboard(self, metric, limit=10, descending=True, status=None,
+                    path=None):
+        """
+        Returns up to `limit` experiments ranked by their last value of
+        `metric`, optionally restricted to a status and a path glob.
+        """
+        sql = ('SELECT e.hash, e.path, e.status, e.iter, e.max_iter, m.value '
+               'FROM metrics m JOIN experiments e ON e.hash = m.hash '
+               'WHERE m.name = ?')
+        args = [metric]
+        if status is not None:
+            sql += ' AND e.status = ?'
+            args.append(status)
+        if path is not None:
+            sql += ' AND e.path GLOB ?'
+            args.append(path)
+        sql += ' ORDER BY m.value %s LIMIT ?' % ('DESC' if descending
+                                                 else 'ASC')
+        args.append(limit)
+
+        keys = ['hash', 'path', 'status', 'iter', 'max_iter', metric]
+        with self.lock:
+            return [dict(zip(keys, row))
+                    for row in self.connection.execute(sql, args)]
+
+    def recent(self, limit, status=2):
+        """
+        Returns (root_path, experiment, state) of the `limit` experiments
+        with the given status that were updated last, oldest first.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT root_path, experiment, state FROM experiments '
+                'WHERE status = ? ORDER BY updated DESC LIMIT ?',
+                (status, limit)).fetchall()
+        return [(root_path, json.loads(experiment), json.loads(state))
+                for root_path, experiment, state in reversed(rows)]
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.connection.close()
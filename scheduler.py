@@ -0,0 +1,227 @@
+from __future__ import print_function
+
+import math
+import heapq
+import itertools
+import traceback
+
+EPSILON = 1e-6
+
+class DeviceScheduler(object):
+    """
+    Priority queue of experiments waiting for devices.
+
+    Every device has a capacity of 1.0. An experiment requests `gpus`
+    devices; a request below one asks for that fraction of a single device,
+    so that several small jobs can share it. Without a device list only the
+    number of simultaneously running experiments is limited (if at all).
+
+    Besides single items, whole sources (iterators of items sharing one
+    priority and request) can be queued. Only the next item of a source is
+    materialized; the following one is drawn once it starts. A source
+    tells with len() how many items it has left at most, and lists
+    placeholders of them with `pending()`. The scheduler does no locking
+    of its own.
+    """
+    def __init__(self, devices=None, limit=0):
+        self.devices = list(devices or [])
+        self.free = dict((d, 1.0) for d in self.devices)
+        self.limit = limit
+        self.num_running = 0
+        self.queue = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def capacity(self):
+        """
+        Returns how much is in use, how much there is in total (None if
+        unlimited) and how much is queued: in devices, or in experiments
+        without a device list. The items of sources that are not drawn yet
+        count as well.
+        """
+        sources = [entry for entry in self.queue if entry[5] is not None]
+        if self.devices:
+            total = len(self.devices)
+            used = total - sum(self.free.values())
+            queued = sum(entry[3] for entry in self.queue)
+            queued += sum(len(entry[5]) * entry[3] for entry in sources)
+        else:
+            total = self.limit if self.limit > 0 else None
+            used = self.num_running
+            queued = len(self.queue)
+            queued += sum(len(entry[5]) for entry in sources)
+        return used, total, queued
+
+    def check_request(self, request):
+        if request <= 0:
+            raise ValueError('Device request has to be positive: %g' % request)
+        if self.devices and request > len(self.devices):
+            raise ValueError('Requested %g devices, only %d available' %
+                             (request, len(self.devices)))
+
+    def push(self, item, priority=0, request=1):
+        self.check_request(request)
+        heapq.heappush(self.queue, (-priority, next(self.counter), 0,
+                                    request, item, None))
+
+    def push_source(self, source, priority=0, request=1):
+        """
+        Queues a source. Its first item is drawn right away, so that an
+        error in it reaches the caller.
+        """
+        self.check_request(request)
+        item = next(source, None)
+        if item is not None:
+            heapq.heappush(self.queue, (-priority, next(self.counter), 0,
+                                        request, item, source))
+
+    def refill(self, entry):
+        """
+        Queues the next item of the source `entry` came from, keeping the
+        source's place in the queue. A source that fails is dropped, as it
+        is drawn from whichever thread takes its items off the queue. One
+        with nothing left is not drawn from at all.
+        """
+        neg_priority, seq, sub, request, _, source = entry
+        if source is None or not len(source):
+            return
+        try:
+            item = next(source, None)
+        except Exception:
+            traceback.print_exc()
+            print('[!] Dropping the rest of a queued sweep.')
+            item = None
+        if item is None:
+            return
+
+        heapq.heappush(self.queue, (neg_priority, seq, sub + 1, request,
+                                    item, source))
+
+    def queued(self):
+        """
+        Queued items, highest priority first, each queued item of a source
+        followed by the placeholders of the items the source has left.
+        """
+        items = []
+        for entry in sorted(self.queue):
+            items.append(entry[4])
+            if entry[5] is not None:
+                items.extend(entry[5].pending())
+        return items
+
+    def discard(self, predicate):
+        """
+        Drops the queued items matching `predicate` and returns them. Their
+        sources move on to the next item.
+        """
+        dropped = [e for e in self.queue if predicate(e[4])]
+        self.queue = [e for e in self.queue if not predicate(e[4])]
+        heapq.heapify(self.queue)
+        for entry in dropped:
+            self.refill(entry)
+        return [entry[4] for entry in dropped]
+
+    def cancel(self, items):
+        """
+        Drops the given items, queued ones as well as placeholders listed by
+        `queued`, and returns those of them that were queued or listed. The
+        placeholders are struck off their sources before any source moves
+        on, so that none draws a point that is being cancelled.
+        """
+        ids = set(id(item) for item in items)
+        cancelled = []
+        for entry in self.queue:
+            source = entry[5]
+            if source is not None:
+                placeholders = [p for p in source.pending() if id(p) in ids]
+                source.cancel(placeholders)
+                cancelled.extend(placeholders)
+        return self.discard(lambda item: id(item) in ids) + cancelled
+
+    def clear(self):
+        """
+        Drops everything queued, including the rest of every source.
+        Returns the items that had been materialized.
+        """
+        items = [entry[4] for entry in self.queue]
+        self.queue = []
+        return items
+
+    def is_full(self):
+        return self.limit > 0 and self.num_running >= self.limit
+
+    def allocate(self, request):
+        """
+        Returns the devices assigned to a request, or None if it does not
+        fit right now.
+        """
+        if self.is_full():
+            return None
+
+        if not self.devices:
+            devices = []
+        elif request >= 1:
+            n = int(math.ceil(request - EPSILON))
+            idle = [d for d in self.devices if self.free[d] > 1.0 - EPSILON]
+            if len(idle) < n:
+                return None
+            devices = idle[:n]
+            for d in devices:
+                self.free[d] = 0.0
+        else:
+            fitting = [d for d in self.devices
+                       if self.free[d] > request - EPSILON]
+            if not fitting:
+                return None
+            # Best fit keeps whole devices available for larger requests.
+            device = min(fitting, key=self.free.get)
+            self.free[device] -= request
+            devices = [device]
+
+        self.num_running += 1
+        return devices
+
+    def reserve(self, devices, request):
+        """
+        Marks the given devices as taken by a request, e.g. one still
+        running from before a restart. Returns those of them that are
+        scheduled over at all.
+        """
+        devices = [d for d in devices if d in self.free]
+        share = min(request, 1.0)
+        for d in devices:
+            self.free[d] = max(self.free[d] - share, 0.0)
+        self.num_running += 1
+        return devices
+
+    def release(self, devices, request):
+        self.num_running -= 1
+        share = min(request, 1.0)
+        for d in devices:
+            self.free[d] = min(self.free[d] + share, 1.0)
+
+    def pop_ready(self):
+        """
+        Takes every queued item that fits into the free devices, highest
+        priority first, and returns (item, devices, request) for each.
+        Lower priority items are allowed to fill the gaps left by larger
+        requests that do not fit yet.
+        """
+        ready = []
+        blocked = []
+        while self.queue and not self.is_full():
+            entry = heapq.heappop(self.queue)
+            request = entry[3]
+            devices = self.allocate(request)
+            if devices is None:
+                blocked.append(entry)
+            else:
+                ready.append((entry[4], devices, request))
+                self.refill(entry)
+
+        for entry in blocked:
+            heapq.heappush(self.queue, entry)
+
+        return ready
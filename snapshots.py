@@ -0,0 +1,119 @@
+import os
+
+from util import save_json, load_json
+
+SOLVER_STATE_SUFFIXES = ('.solverstate', '.solverstate.h5')
+
+class SnapshotIndex(object):
+    """
+    Snapshots of one experiment by iteration, as announced in its log, kept
+    in a JSON file so that resuming does not have to scan the snapshots
+    directory.
+
+    `policy` is the experiment's `snapshots` setting. Besides the latest
+    snapshot, which training resumes from, the last `keep_last` ones and
+    the `keep_best` ones by `metric` are kept; 0 means no limit. A snapshot
+    is scored with the first value of the metric reported at or after its
+    iteration.
+    """
+    def __init__(self, path, policy):
+        self.path = path
+        self.policy = policy
+        # iteration -> {'files': [...], 'value': None or float}
+        self.snapshots = {}
+        # Iterations deleted by the policy, which a re-parsed log must not
+        # bring back.
+        self.pruned = set()
+        self.load()
+
+    def load(self):
+        index = load_json(self.path)
+        if index is None:
+            return
+        for entry in index['snapshots']:
+            self.snapshots[entry['iter']] = {
+                'files': entry['files'],
+                'value': entry['value']
+            }
+        self.pruned = set(index['pruned'])
+
+    def save(self):
+        save_json(self.path, {
+            'snapshots': [{'iter': iteration,
+                           'files': entry['files'],
+                           'value': entry['value']}
+                          for iteration, entry in self.snapshots.items()],
+            'pruned': list(self.pruned)
+        })
+
+    def add(self, iteration, path):
+        if iteration in self.pruned:
+            return
+        entry = self.snapshots.setdefault(iteration,
+                                          {'files': [], 'value': None})
+        if path not in entry['files']:
+            entry['files'].append(path)
+
+    def score(self, outputs):
+        metric = self.policy['metric']
+        if not metric:
+            return
+        for name, iteration, value in outputs:
+            if name != metric:
+                continue
+            for snapshot_iter, entry in self.snapshots.items():
+                if entry['value'] is None and snapshot_iter <= iteration:
+                    entry['value'] = value
+
+    def update(self, snapshots, outputs):
+        """
+        Records new snapshots and metric values. Returns the files that fell
+        out of the retention policy; they are forgotten right away but left
+        for the caller to delete.
+        """
+        for iteration, path in snapshots:
+            self.add(iteration, path)
+        self.score(outputs)
+
+        to_delete = self.prune()
+        if snapshots or to_delete:
+            self.save()
+        return to_delete
+
+    def prune(self):
+        keep_last = self.policy['keep_last']
+        keep_best = self.policy['keep_best']
+        if not self.snapshots or (keep_last <= 0 and keep_best <= 0):
+            return []
+
+        iterations = sorted(self.snapshots)
+        kept = set(iterations[-max(keep_last, 1):])
+
+        if keep_best > 0:
+            scored = [i for i in iterations
+                      if self.snapshots[i]['value'] is not None]
+            scored.sort(key=lambda i: self.snapshots[i]['value'],
+                        reverse=(self.policy['mode'] == 'max'))
+            kept.update(scored[:keep_best])
+            # Snapshots waiting for their score cannot be judged yet.
+            kept.update(i for i in iterations
+                        if self.snapshots[i]['value'] is None)
+
+        to_delete = []
+        for iteration in iterations:
+            if iteration not in kept:
+                to_delete.extend(self.snapshots.pop(iteration)['files'])
+                self.pruned.add(iteration)
+        return to_delete
+
+    def latest_solverstate(self):
+        """
+        Returns the solver state of the latest snapshot, or None if it is
+        not known or does not exist anymore.
+        """
+        if not self.snapshots:
+            return None
+        for path in self.snapshots[max(self.snapshots)]['files']:
+            if path.endswith(SOLVER_STATE_SUFFIXES) and os.path.exists(path):
+                return path
+        return None
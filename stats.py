@@ -0,0 +1,225 @@
+import time
+import bisect
+import threading
+import functools
+import multiprocessing as mp
+
+# Instrumentation is off unless the server turns it on before it starts
+# any worker; forked workers inherit the setting.
+enabled = False
+
+# Upper bounds of the histogram buckets, in seconds. The last bucket
+# counts whatever is above them.
+BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]
+
+# Layout of the counters of an experiment runner, see `make_counters`.
+LINES = 0
+BATCHES = 1
+PARSE_SECONDS = 2
+LOCK_WAIT_SECONDS = 3
+LOCK_ACQUISITIONS = 4
+PARSE_BUCKETS = 5
+NUM_COUNTERS = PARSE_BUCKETS + len(BUCKETS) + 1
+
+def enable():
+    global enabled
+    enabled = True
+
+def histogram_dict(counts, total):
+    return {
+        'bounds': BUCKETS,
+        'counts': list(counts),
+        'count': int(sum(counts)),
+        'sum': total
+    }
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+    def as_dict(self):
+        return histogram_dict(self.counts, self.sum)
+
+class RPCStats(object):
+    """
+    Latency histograms of the server methods, by method name.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def observe(self, method, seconds):
+        with self.lock:
+            histogram = self.histograms.get(method)
+            if histogram is None:
+                histogram = Histogram()
+                self.histograms[method] = histogram
+            histogram.observe(seconds)
+
+    def as_dict(self):
+        with self.lock:
+            return dict((method, histogram.as_dict())
+                        for method, histogram in self.histograms.items())
+
+rpc = RPCStats()
+
+def timed(method):
+    """
+    Records the latency of every call of a server method in `rpc`.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return method(*args, **kwargs)
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            rpc.observe(name, time.time() - start)
+    return wrapper
+
+def make_counters():
+    """
+    Counters of one experiment runner, in shared memory so that the server
+    can read them while a worker process writes them. Every slot has a
+    single writer at a time, so they go without a lock of their own.
+    """
+    return mp.Array('d', NUM_COUNTERS, lock=False)
+
+def record_batch(counters, lines, seconds):
+    counters[LINES] += lines
+    counters[BATCHES] += 1
+    counters[PARSE_SECONDS] += seconds
+    counters[PARSE_BUCKETS + bisect.bisect_left(BUCKETS, seconds)] += 1
+
+def counters_dict(counters):
+    counters = counters[:]
+    return {
+        'lines': int(counters[LINES]),
+        'batches': int(counters[BATCHES]),
+        'parse_seconds': histogram_dict(
+            [int(c) for c in counters[PARSE_BUCKETS:]],
+            counters[PARSE_SECONDS]),
+        'lock_wait_seconds': counters[LOCK_WAIT_SECONDS],
+        'lock_acquisitions': int(counters[LOCK_ACQUISITIONS])
+    }
+
+class TimedLock(object):
+    """
+    Wraps a lock to add up how long acquiring it took in `counters`. They
+    are updated while the lock is held, so both the server and a worker
+    can take it.
+    """
+    def __init__(self, lock, counters):
+        self.lock = lock
+        self.counters = counters
+
+    def __enter__(self):
+        start = time.time()
+        self.lock.acquire()
+        self.counters[LOCK_WAIT_SECONDS] += time.time() - start
+        self.counters[LOCK_ACQUISITIONS] += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+def escape_label(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, escape_label(unicode(v)))
+                             for k, v in labels)
+
+def format_histogram(name, labels, histogram):
+    lines = []
+    cumulative = 0
+    bounds = [repr(b) for b in histogram['bounds']] + ['+Inf']
+    for bound, count in zip(bounds, histogram['counts']):
+        cumulative += count
+        lines.append('%s_bucket%s %d' % (
+            name, format_labels(labels + [('le', bound)]), cumulative))
+    lines.append('%s_sum%s %r' % (name, format_labels(labels),
+                                  histogram['sum']))
+    lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                    histogram['count']))
+    return lines
+
+def prometheus_text(stats):
+    """
+    Renders what `AutomatorServer.get_stats` returns in the Prometheus text
+    exposition format.
+    """
+    out = []
+
+    def header(name, kind, description):
+        out.append('# HELP %s %s' % (name, description))
+        out.append('# TYPE %s %s' % (name, kind))
+
+    header('automator_processes', 'gauge',
+           'Experiments running and queued.')
+    for state in ['live', 'queued']:
+        out.append('automator_processes{state="%s"} %d' % (
+            state, stats['processes'][state]))
+
+    header('automator_rpc_seconds', 'histogram',
+           'Latency of the server methods.')
+    for method, histogram in sorted(stats['rpc'].items()):
+        out.extend(format_histogram('automator_rpc_seconds',
+                                    [('method', method)], histogram))
+
+    experiments = stats['experiments']
+
+    header('automator_log_lag_bytes', 'gauge',
+           'Bytes of the training log not parsed yet.')
+    for e in experiments:
+        out.append('automator_log_lag_bytes%s %d' % (
+            format_labels([('path', e['path'])]), e['log_lag']))
+
+    instrumented = [e for e in experiments if 'lines' in e]
+    if not instrumented:
+        return '\n'.join(out) + '\n'
+
+    header('automator_lines_parsed_total', 'counter',
+           'Training log lines parsed.')
+    for e in instrumented:
+        out.append('automator_lines_parsed_total%s %d' % (
+            format_labels([('path', e['path'])]), e['lines']))
+
+    header('automator_lines_parsed_per_second', 'gauge',
+           'Training log lines parsed per second since the last sample.')
+    for e in instrumented:
+        if e['lines_per_sec'] is not None:
+            out.append('automator_lines_parsed_per_second%s %r' % (
+                format_labels([('path', e['path'])]), e['lines_per_sec']))
+
+    header('automator_parse_seconds', 'histogram',
+           'Time spent parsing one batch of log lines.')
+    for e in instrumented:
+        out.extend(format_histogram('automator_parse_seconds',
+                                    [('path', e['path'])],
+                                    e['parse_seconds']))
+
+    header('automator_state_lock_wait_seconds_total', 'counter',
+           'Time spent waiting for the state lock of an experiment.')
+    for e in instrumented:
+        out.append('automator_state_lock_wait_seconds_total%s %r' % (
+            format_labels([('path', e['path'])]), e['lock_wait_seconds']))
+
+    header('automator_state_lock_acquisitions_total', 'counter',
+           'Acquisitions of the state lock of an experiment.')
+    for e in instrumented:
+        out.append('automator_state_lock_acquisitions_total%s %d' % (
+            format_labels([('path', e['path'])]), e['lock_acquisitions']))
+
+    return '\n'.join(out) + '\n'
@@ -0,0 +1,380 @@
+from __future__ import print_function
+
+import os
+import errno
+import signal
+import select
+import threading
+import traceback
+from collections import deque
+
+from worker import ExperimentRunner, waiting_state, KILL_GRACE
+from log_tail import make_inotify, set_nonblocking, drain, LOG_EVENTS
+from util import signal_group, live_process_groups
+
+POLL_INTERVAL = 5
+# Exits of training processes cannot be waited for from this thread
+# (SIGCHLD goes to the main one), and the last write to the log may happen
+# before the watch is set up. Hence running jobs are re-checked this often
+# even when the logs are quiet.
+EXIT_CHECK_INTERVAL = 1
+# Jobs being stopped are checked more often, so that their devices are
+# released as soon as their training processes are gone.
+STOP_CHECK_INTERVAL = 0.05
+
+class Job(object):
+    """
+    Handle of an experiment owned by the `Supervisor`. It mimics the part of
+    the `Worker` interface used by the server. The runner, together with its
+    shared state and log machinery, is only created once the experiment
+    gets launched, so queued experiments cost no more than their dicts.
+    """
+    def __init__(self, supervisor, root_path, experiment):
+        self.supervisor = supervisor
+        self.root_path = root_path
+        self.experiment = experiment
+        self.runner = None
+        # Value history of the runner, kept once the job is done.
+        self.history = None
+        self.allocation = None
+        self.is_terminated = False
+        self.grace = KILL_GRACE
+        self.finished = threading.Event()
+
+    def get_state(self):
+        runner = self.runner
+        if runner is not None:
+            return runner.get_state()
+        return waiting_state(self.experiment)
+
+    def get_version(self):
+        runner = self.runner
+        if runner is not None:
+            return runner.get_version()
+        return 0
+
+    def get_stats(self):
+        runner = self.runner
+        if runner is not None:
+            return runner.get_stats()
+        return None
+
+    def get_history(self, value_name=None, start=0, stop=None):
+        if self.runner is None:
+            return {}
+        return self.runner.get_history(value_name, start, stop)
+
+    def get_metrics(self, names=None, start=0, stop=None):
+        if self.runner is None:
+            return {}
+        return self.runner.get_metrics(names, start, stop)
+
+    def set_paused(self, paused):
+        runner = self.runner
+        if runner is not None:
+            return runner.set_paused(paused)
+        return False
+
+    def shutdown(self, grace=None):
+        if grace is not None:
+            self.grace = grace
+        self.is_terminated = True
+        if not self.supervisor.cancel([self]):
+            self.supervisor.wakeup()
+
+    def is_alive(self):
+        return not self.finished.is_set()
+
+    def join(self, timeout=None):
+        self.finished.wait(timeout)
+
+
+class Supervisor(threading.Thread):
+    """
+    Runs every experiment from a single event loop: launches the training
+    processes, tails all their logs and owns all the state. The loop sleeps
+    in one select() on an inotify instance watching every log directory
+    and on a wakeup pipe used by the server.
+    """
+    def __init__(self, scheduler, tail='auto', journal=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.scheduler = scheduler
+        self.journal = journal
+        self.lock = threading.Lock()
+        # Jobs that need no devices (--no-run) skip the scheduler.
+        self.pending = deque()
+        # Jobs taken off the queue and not cleaned up yet.
+        self.jobs = []
+        self.running = []
+        # Process groups alive as of this round, if any job is being
+        # stopped; one scan of /proc serves all of them.
+        self.live_groups = None
+
+        self.inotify = make_inotify(tail)
+        self.watches = {}
+
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        set_nonblocking(self.wakeup_r)
+        set_nonblocking(self.wakeup_w)
+
+    def submit(self, root_path, experiment):
+        job = Job(self, root_path, experiment)
+        with self.lock:
+            if experiment['no_run']:
+                self.pending.append(job)
+            else:
+                self.scheduler.push(job, experiment['priority'],
+                                    experiment['gpus'])
+        self.wakeup()
+        return job
+
+    def submit_source(self, source, priority=0, request=1):
+        """
+        Queues a source of jobs, e.g. a lazily expanded sweep (see
+        `DeviceScheduler.push_source`).
+        """
+        with self.lock:
+            self.scheduler.push_source(source, priority, request)
+        self.wakeup()
+
+    def entries(self):
+        """
+        Jobs taken off the queue, followed by the ones still queued.
+        """
+        with self.lock:
+            return self.jobs + list(self.pending) + self.scheduler.queued()
+
+    def cleanup(self):
+        """
+        Forgets the jobs that are done and returns them.
+        """
+        with self.lock:
+            done = [job for job in self.jobs if not job.is_alive()]
+            self.jobs = [job for job in self.jobs if job.is_alive()]
+            done.extend(self.scheduler.discard(lambda j: not j.is_alive()))
+        return done
+
+    def clear(self):
+        """
+        Drops every queued job, including the unexpanded rest of the sweeps.
+        """
+        with self.lock:
+            dropped = self.scheduler.clear() + list(self.pending)
+            self.pending.clear()
+        for job in dropped:
+            job.finished.set()
+        return dropped
+
+    def cancel(self, jobs):
+        """
+        Drops the given jobs that are still queued, and the given
+        placeholders of unexpanded sweep points (see
+        `DeviceScheduler.cancel`). Returns those of them that were.
+        """
+        ids = set(id(job) for job in jobs)
+        with self.lock:
+            dropped = [job for job in self.pending if id(job) in ids]
+            if dropped:
+                self.pending = deque(job for job in self.pending
+                                     if id(job) not in ids)
+            dropped.extend(self.scheduler.cancel(jobs))
+        for job in dropped:
+            if isinstance(job, Job):
+                job.finished.set()
+        return dropped
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError as e:
+            # A full pipe means a wakeup is pending anyway.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def run(self):
+        while True:
+            self.launch_pending()
+
+            self.live_groups = None
+            if any(job.is_terminated for job in self.running):
+                self.live_groups = live_process_groups()
+
+            busy = False
+            for job in self.running[:]:
+                try:
+                    busy |= self.step(job)
+                except Exception:
+                    traceback.print_exc()
+                    self.abandon(job)
+
+            if not busy:
+                self.wait()
+
+    def launch_pending(self):
+        with self.lock:
+            ready = [(job, None, None) for job in self.pending]
+            self.pending.clear()
+            ready.extend(self.scheduler.pop_ready())
+            self.jobs.extend(job for job, _, _ in ready)
+
+        for job, devices, request in ready:
+            if devices is not None:
+                job.allocation = (devices, request)
+            try:
+                self.launch(job)
+            except Exception:
+                traceback.print_exc()
+                self.release(job)
+                job.finished.set()
+
+    def release(self, job):
+        if job.allocation is not None:
+            with self.lock:
+                self.scheduler.release(*job.allocation)
+            job.allocation = None
+
+    def launch(self, job):
+        if job.is_terminated:
+            self.release(job)
+            job.finished.set()
+            return
+
+        devices = job.allocation[0] if job.allocation else None
+        runner = ExperimentRunner(job.root_path, job.experiment, devices)
+        runner.prepare_directories()
+
+        if runner.no_run:
+            job.runner = runner
+            job.finished.set()
+            return
+
+        runner.set_status(1)
+        runner.run_training()
+        job.runner = runner
+        job.history = runner.history
+
+        if self.journal is not None and job.allocation is not None:
+            self.journal.launched(job.root_path, job.experiment,
+                                  *job.allocation)
+
+        self.follow(job)
+
+    def attach(self, root_path, experiment, devices, request, process):
+        """
+        Takes over a training process launched before a server restart. It
+        has to be called before the supervisor is started.
+        """
+        job = Job(self, root_path, experiment)
+        job.allocation = (devices, request)
+
+        runner = ExperimentRunner(root_path, experiment, devices)
+        runner.set_status(1)
+        runner.attach_training(process)
+        job.runner = runner
+        job.history = runner.history
+
+        self.jobs.append(job)
+        self.follow(job)
+        return job
+
+    def follow(self, job):
+        if self.inotify is not None:
+            wd = self.inotify.add_watch(job.runner.logs_path, LOG_EVENTS)
+            self.watches[job] = wd
+
+        self.running.append(job)
+
+    def step(self, job):
+        """
+        Handles one round of a running job. Returns True if there may be
+        more log data to parse right away.
+        """
+        runner = job.runner
+
+        if job.is_terminated:
+            if runner.stop_training(job.grace, self.live_groups):
+                self.finish(job)
+            return False
+
+        if runner.log_file is None and not runner.open_log():
+            if runner.training_process.poll() is not None:
+                self.finish(job)
+            return False
+
+        got_data = runner.ingest()
+        runner.publish_state()
+
+        # The log is drained, so we are done as soon as the training
+        # process is.
+        if not got_data and runner.training_process.poll() is not None:
+            self.finish(job)
+
+        return got_data
+
+    def finish(self, job):
+        job.runner.close_log()
+        job.runner.set_status(2)
+
+        wd = self.watches.pop(job, None)
+        if wd is not None:
+            self.inotify.remove_watch(wd)
+
+        self.running.remove(job)
+        self.release(job)
+        job.finished.set()
+
+    def abandon(self, job):
+        """
+        Gives up on a job that could not be handled, e.g. because its log
+        could not be read. Its training process is killed, since it would
+        go on using the devices that are released here.
+        """
+        print('[!] Giving up on %s.' % job.experiment['path'])
+        runner = job.runner
+        pgid = runner.state['pgid'].value
+        if pgid > 0:
+            try:
+                signal_group(pgid, signal.SIGKILL)
+            except OSError:
+                pass
+        try:
+            runner.close_log()
+        except Exception:
+            traceback.print_exc()
+        runner.set_status(2)
+
+        wd = self.watches.pop(job, None)
+        if wd is not None:
+            try:
+                self.inotify.remove_watch(wd)
+            except OSError:
+                pass
+
+        if job in self.running:
+            self.running.remove(job)
+        self.release(job)
+        job.finished.set()
+
+    def wait(self):
+        fds = [self.wakeup_r]
+        if self.inotify is None:
+            timeout = POLL_INTERVAL
+        else:
+            fds.append(self.inotify.fd)
+            timeout = EXIT_CHECK_INTERVAL if self.running else None
+        if any(job.is_terminated for job in self.running):
+            timeout = STOP_CHECK_INTERVAL
+
+        try:
+            readable, _, _ = select.select(fds, [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        if self.wakeup_r in readable:
+            drain(self.wakeup_r)
+        if self.inotify is not None and self.inotify.fd in readable:
+            self.inotify.read_events()
@@ -1,6 +1,13 @@
 import os
+import errno
 import shutil
 import glob
+import json
+import itertools
+import threading
+import Queue
+
+trash_counter = itertools.count()
 
 def clear_dir(path):
     try:
@@ -9,6 +16,73 @@ def clear_dir(path):
         pass
     os.makedirs(path)
 
+def move_aside(path):
+    """
+    Renames `path` out of the way, so that deleting it can be left for
+    later. Returns the new name, or None if there was nothing to move.
+    """
+    trash_path = '%s.trash.%d.%d' % (path, os.getpid(), next(trash_counter))
+    try:
+        os.rename(path, trash_path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    return trash_path
+
+def clear_dir_later(path):
+    """
+    Like `clear_dir`, but moves the old contents aside instead of deleting
+    them. Returns the paths that are left to be deleted.
+    """
+    trash_path = move_aside(path)
+    os.makedirs(path)
+    return [trash_path] if trash_path else []
+
+class BackgroundDeleter(object):
+    """
+    Deletes files and directory trees from a thread of its own. The thread
+    is started on first use in every process.
+    """
+    def __init__(self):
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def delete(self, paths):
+        if not paths:
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                # Threads do not survive a fork; start over in the child.
+                self.queue = Queue.Queue()
+                thread = threading.Thread(target=self.run)
+                thread.daemon = True
+                thread.start()
+                self.pid = os.getpid()
+        for path in paths:
+            self.queue.put(path)
+
+    def run(self):
+        while True:
+            path = self.queue.get()
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+            except OSError:
+                pass
+            self.queue.task_done()
+
+    def wait(self):
+        """
+        Blocks until everything handed over so far is deleted.
+        """
+        if self.pid == os.getpid():
+            self.queue.join()
+
+deleter = BackgroundDeleter()
+
 def get_latest(path, pattern='*'):
     found = glob.iglob(os.path.join(path, pattern))
     try:
@@ -16,3 +90,123 @@ def get_latest(path, pattern='*'):
         return os.path.basename(newest)
     except:
         return None
+
+def write_atomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+def read_proc_stat(pid):
+    """
+    Fields of /proc/<pid>/stat after the command name, starting with the
+    state, or None if there is no such process (or no /proc).
+    """
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as f:
+            stat = f.read()
+    except IOError:
+        return None
+    # The command name may contain spaces, so split after its closing paren.
+    return stat[stat.rindex(')') + 2:].split()
+
+def process_start_time(pid):
+    """
+    Start time of a process in clock ticks after boot, which tells it apart
+    from a later process that got the same pid. None if it cannot be told.
+    """
+    stat = read_proc_stat(pid)
+    if stat is None:
+        return None
+    return int(stat[19])
+
+def process_running(pid):
+    """
+    Whether a process exists and has not exited. Zombies count as exited:
+    a process we did not start may never get reaped.
+    """
+    stat = read_proc_stat(pid)
+    if stat is not None:
+        return stat[0] not in 'ZX'
+
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+def signal_group(pgid, signum):
+    """
+    Sends a signal to a process group. Returns False if the group is gone.
+    """
+    try:
+        os.killpg(pgid, signum)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+        return False
+    return True
+
+def live_process_groups():
+    """
+    The process groups with a process that has not exited, from one scan
+    of /proc, or None if there is no /proc.
+    """
+    try:
+        pids = os.listdir('/proc')
+    except OSError:
+        return None
+
+    groups = set()
+    for name in pids:
+        if not name.isdigit():
+            continue
+        stat = read_proc_stat(int(name))
+        # Fields: state, ppid, pgrp.
+        if stat is not None and stat[0] not in 'ZX':
+            groups.add(int(stat[2]))
+    return groups
+
+def process_group_running(pgid, live=None):
+    """
+    Whether any process of a group has not exited. As with
+    `process_running`, zombies count as exited. Once the group leader is
+    gone, telling takes a scan of /proc; callers checking many groups at a
+    time can share one by passing what `live_process_groups` returned.
+    """
+    try:
+        os.killpg(pgid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+
+    if process_running(pgid):
+        return True
+    if live is None:
+        live = live_process_groups()
+    return live is None or pgid in live
+
+def write_if_changed(path, data):
+    """
+    Writes `data` to `path` unless the file holds exactly that already.
+    Returns whether it was written.
+    """
+    try:
+        with open(path, 'r') as f:
+            if f.read() == data:
+                return False
+    except IOError:
+        pass
+
+    with open(path, 'w') as f:
+        f.write(data)
+    return True
+
+def save_json(path, o):
+    write_atomic(path, json.dumps(o))
+
+def load_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
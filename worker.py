@@ -2,76 +2,343 @@ import os
 import stat 
 import sys
 import re
+import math
 import time
+import hashlib
 
 from string import Template
 import multiprocessing as mp
 import subprocess
 import signal
 
+import stats
 import default_scripts
-from util import clear_dir, get_latest
+from util import (clear_dir_later, get_latest, save_json, load_json,
+                  write_if_changed, deleter, process_start_time,
+                  process_running, process_group_running, signal_group)
+from log_parser import make_parser
+from log_tail import make_log_watcher, ChunkedLogReader
+from history import MetricHistory
+from metrics_store import MetricsWriter, MetricsReader
+from snapshots import SnapshotIndex
+
+AUTOMATOR_PATH = os.path.dirname(os.path.abspath(__file__))
 
 GPU_ID = 0
+LOG_CHUNK_SIZE = 1 << 20
+CHECKPOINT_INTERVAL = 10
+# Seconds a training process gets to exit on SIGTERM before it is killed.
+KILL_GRACE = 10
+# Seconds a training process is given to go away after SIGKILL before it is
+# no longer waited for, e.g. when stuck in the GPU driver.
+KILL_TIMEOUT = 10
+STOP_POLL_INTERVAL = 0.05
+MATERIALIZE_CHUNK_SIZE = 64
 
 re_snapshot_prefix = re.compile('snapshot_prefix:\s*"([^"]+)"')
-re_max_iter = re.compile('^max_iter: (\d+)')
-re_iteration = re.compile('Iteration (\d+)')
-re_top_output = re.compile('Iteration \d+, (\w+) = ([\.\d]+(e[+-][\d]+)*)')
-re_output = re.compile('(Test|Train) net output #\d+: '
-                       '(\w+) = ([\.\d]+(e[+-][\d]+)*)')
-
-class Worker(mp.Process):
-    def __init__(self, root_path, experiment, limit_sem=None):
-        mp.Process.__init__(self)
+re_max_iter = re.compile('^[ \t]*max_iter:.*$', re.M)
+
+def waiting_state(experiment):
+    """
+    State reported for an experiment that has not been launched yet.
+    """
+    return {
+        'status': 0,
+        'iter': 0.0,
+        'max_iter': 0.0,
+        'watched_values': [0.0] * len(experiment['watch']),
+        'log_lag': 0.0,
+        'pgid': 0,
+        'version': 0
+    }
+
+TRAIN_TEMPLATE = Template(default_scripts.TRAIN_TEMPLATE)
+PLOT_TEMPLATE = Template(default_scripts.PLOT_TEMPLATE)
+
+# path -> (mtime, Template)
+template_cache = {}
+
+def load_template(path):
+    """
+    Returns the template stored at `path`, reading it again only when the
+    file has changed.
+    """
+    mtime = os.path.getmtime(path)
+    cached = template_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, Template(file(path, 'r').read()))
+        template_cache[path] = cached
+    return cached[1]
+
+def proto_paths(root_path, experiment):
+    protos_path = os.path.join(os.path.abspath(root_path), experiment['path'],
+                               'protos')
+    return (os.path.join(protos_path, 'train_val.prototxt'),
+            os.path.join(protos_path, 'solver.prototxt'))
+
+def render_protos(root_path, experiment):
+    """
+    Returns the model and solver prototxt of an experiment.
+    """
+    model_template = load_template(experiment['model']['template'])
+    solver_template = load_template(experiment['solver']['template'])
+
+    model_path, _ = proto_paths(root_path, experiment)
+
+    model_values = experiment['model']['values']
+    solver_values = dict(experiment['solver']['values'])
+
+    solver_values.update({
+        'net': model_path,
+        'root': os.path.abspath(root_path),
+        'path': experiment['path']
+    })
+
+    solver = solver_template.substitute(solver_values)
+    if 'max_iter' in experiment:
+        # A trunk stops short of what the template says.
+        max_iter = 'max_iter: %d' % experiment['max_iter']
+        solver, found = re_max_iter.subn(max_iter, solver)
+        if not found:
+            solver += '\n' + max_iter + '\n'
+
+    return model_template.substitute(model_values), solver
+
+def make_hash(root_path, experiment, protos=None):
+    """
+    Digest of the rendered model and solver prototxt of an experiment. It is
+    stable across server restarts, unlike hash(). `protos` are the rendered
+    ones, if at hand.
+    """
+    model, solver = protos or render_protos(root_path, experiment)
+    return hashlib.sha1(model + '\0' + solver).hexdigest()
+
+def write_protos(root_path, experiment, protos=None):
+    model, solver = protos or render_protos(root_path, experiment)
+    model_path, solver_path = proto_paths(root_path, experiment)
+    write_if_changed(model_path, model)
+    write_if_changed(solver_path, solver)
+
+def write_scripts(scripts_path, solver_path, metrics_path):
+    scripts = {
+        'train.sh': TRAIN_TEMPLATE.substitute({'solver_path': solver_path}),
+        'plot.sh': PLOT_TEMPLATE.substitute({
+            'automator_path': AUTOMATOR_PATH,
+            'metrics_path': metrics_path
+        })
+    }
+
+    for name, script in scripts.items():
+        path = os.path.join(scripts_path, name)
+        if write_if_changed(path, script):
+            os.chmod(path, 0744)
+
+def get_snapshots_directory(solver_path):
+    snapshot_prefix_match = re_snapshot_prefix.search(
+        file(solver_path, 'r').read())
+    return os.path.dirname(snapshot_prefix_match.group(1))
+
+def materialize(root_path, experiment, protos=None):
+    """
+    Creates the directory of an experiment along with its protos and
+    scripts, as the replace mode asks for. Files that already hold the
+    right contents are not rewritten. `protos` are the rendered ones, if
+    at hand. Returns the snapshots directory and the old directories moved
+    aside, which are left for the caller to delete.
+    """
+    path = os.path.join(os.path.abspath(root_path), experiment['path'])
+    protos_path = os.path.join(path, 'protos')
+    logs_path = os.path.join(path, 'logs')
+    scripts_path = os.path.join(path, 'scripts')
+    _, solver_path = proto_paths(root_path, experiment)
+    replace_mode = experiment['replace_mode']
+
+    if replace_mode == 1 and os.path.exists(protos_path):
+        write_protos(root_path, experiment, protos)
+
+    if replace_mode in [0, 1] and os.path.exists(path):
+        return get_snapshots_directory(solver_path), []
+
+    for d in [protos_path, scripts_path]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    trash = clear_dir_later(logs_path)
+
+    write_protos(root_path, experiment, protos)
+    write_scripts(scripts_path, solver_path,
+                  os.path.join(logs_path, 'metrics'))
+
+    snapshots_path = get_snapshots_directory(solver_path)
+    trash.extend(clear_dir_later(snapshots_path))
+    return snapshots_path, trash
+
+# Collections of the hashes that `materialize_point` skips, set in every
+# process of the pool.
+materialize_skip = ()
+
+def init_materialize(skip):
+    global materialize_skip
+    materialize_skip = skip
+
+def materialize_point(args):
+    """
+    Renders and hashes an experiment, then materializes it unless it is to
+    be skipped. Returns its path, the old directories to delete, or None if
+    it was skipped, and the error it could not be rendered with, if any.
+    """
+    root_path, experiment = args
+    path = experiment['path']
+    try:
+        protos = render_protos(root_path, experiment)
+    except (KeyError, ValueError, EnvironmentError) as error:
+        return path, None, error
+
+    h = make_hash(root_path, experiment, protos)
+    if any(h in hashes for hashes in materialize_skip):
+        return path, None, None
+    experiment['hash'] = h
+    return path, materialize(root_path, experiment, protos)[1], None
+
+def materialize_all(root_path, experiments, skip=(), processes=None):
+    """
+    Materializes many experiments at once in a pool of processes, which
+    render and hash them as well. Those with a hash in one of the `skip`
+    collections are left out. Returns how many were prepared. Old
+    directories are deleted from this process, as the pool does not
+    outlive the call.
+    """
+    pool = mp.Pool(processes, init_materialize, (skip,))
+    try:
+        count = 0
+        for path, trash, error in pool.imap_unordered(
+                materialize_point,
+                ((root_path, e) for e in experiments),
+                MATERIALIZE_CHUNK_SIZE):
+            if error is not None:
+                print('[!] Skipping %s: %r' % (path, error))
+            elif trash is not None:
+                deleter.delete(trash)
+                count += 1
+    finally:
+        pool.close()
+        pool.join()
+    return count
+
+def warm_start_snapshot(root_path, experiment):
+    """
+    Returns the last solver state of the trunk that a branch experiment
+    forks from, or None if there is none.
+    """
+    _, solver_path = proto_paths(root_path,
+                                 {'path': experiment['warm_start']})
+    snapshots_path = get_snapshots_directory(solver_path)
+    latest = get_latest(snapshots_path, '*solverstate')
+    if latest:
+        return os.path.join(snapshots_path, latest)
+    return None
+
+def process_info_path(root_path, experiment):
+    return os.path.join(os.path.abspath(root_path), experiment['path'],
+                        'logs', 'process.json')
+
+def find_training_process(root_path, experiment):
+    """
+    Returns the pid, process group and start time of the training process
+    of an experiment if it is still running, None otherwise.
+    """
+    process = load_json(process_info_path(root_path, experiment))
+    if process is None or not process_running(process['pid']):
+        return None
+
+    # The pid may have been reused by now.
+    start_time = process_start_time(process['pid'])
+    if (start_time is not None and process['start_time'] is not None and
+            start_time != process['start_time']):
+        return None
+
+    return process
+
+class AttachedProcess(object):
+    """
+    Stands in for the Popen object of a training process that an earlier
+    server launched. It is not our child, so its exit can only be noticed
+    by probing it, and its exit code is unknown.
+    """
+    def __init__(self, pid, pgid):
+        self.pid = pid
+        self.pgid = pgid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None and not process_running(self.pid):
+            self.returncode = 0
+        return self.returncode
+
+class ExperimentRunner(object):
+    """
+    Sets up, launches and follows a single experiment. It does not care
+    where it runs: `Worker` drives it from a process of its own, while the
+    `Supervisor` drives many of them from one event loop.
+    """
+    def __init__(self, root_path, experiment, devices=None):
+        """
+        `devices` are the device slots the scheduler assigned to the
+        experiment. They are exported as CUDA_VISIBLE_DEVICES.
+        """
         self.root_path = os.path.abspath(root_path)
         self.experiment = experiment
         self.caffe_root = experiment['caffe_root']
         self.custom_command = experiment['command']
         self.no_run = experiment['no_run']
         self.replace_mode = experiment['replace_mode']
+        self.devices = devices or []
+        self.metrics_path = os.path.join(
+            self.root_path, experiment['path'], 'logs', 'metrics')
 
         num_watched = len(experiment['watch'])
-        self.watched_dict = dict(zip(experiment['watch'], range(num_watched))) 
 
         self.state_lock = mp.Lock()
+        self.counters = None
+        if stats.enabled:
+            self.counters = stats.make_counters()
+            self.state_lock = stats.TimedLock(self.state_lock, self.counters)
         self.state = {
             'status': mp.Value('i', 0),
             'iter': mp.Value('f', 0.0),
             'max_iter': mp.Value('f', 0.0),
-            'watched_values': mp.Array('f', [0] * num_watched)
+            'watched_values': mp.Array('f', [0] * num_watched),
+            'log_lag': mp.Value('d', 0.0),
+            # Process group of the training process, 0 until launched.
+            'pgid': mp.Value('i', 0),
+            # Bumped whenever any of the above changes.
+            'version': mp.Value('i', 0, lock=False)
         }
+        self.history = MetricHistory(experiment['watch'],
+                                     **experiment['history'])
 
-        self.control_cond = mp.Condition()
-        self.is_terminated = mp.Value('i', 0)
-
-        self.limit_sem = limit_sem
-
-    def run(self):
-        self.prepare_directories()
-
-        if self.no_run:
-            return
-
-        if self.limit_sem:
-            self.limit_sem.acquire()
+        self.log_file = None
+        # When the training process gets SIGKILL if it is still around.
+        self.kill_deadline = None
 
+    def set_status(self, status):
         with self.state_lock:
-            self.state['status'].value = 1
-
-        self.run_training()
-        self.main_loop()
-
+            self.state['status'].value = status
+            self.state['version'].value += 1
+
+    def set_paused(self, paused):
+        """
+        Marks a running experiment as paused, or a paused one as running
+        again. Returns False if it is not, e.g. because it finished.
+        """
         with self.state_lock:
-            self.state['status'].value = 2
-        
-        if self.limit_sem:
-            self.limit_sem.release()
+            if self.state['status'].value != (1 if paused else 3):
+                return False
+            self.state['status'].value = 3 if paused else 1
+            self.state['version'].value += 1
+            return True
 
-    def shutdown(self):
-        with self.control_cond:
-            self.is_terminated.value = 1
-            self.control_cond.notify()
+    def get_version(self):
+        return self.state['version'].value
 
     def get_state(self):
         state = {}
@@ -83,90 +350,102 @@ class Worker(mp.Process):
                     state[k] = v[:]
         return state
 
-    def prepare_directories(self):
-        self.path = os.path.join(self.root_path, self.experiment['path'])
+    def get_stats(self):
+        s = {'log_lag': self.state['log_lag'].value}
+        if self.counters is not None:
+            s.update(stats.counters_dict(self.counters))
+        return s
 
-        self.protos_path = os.path.join(self.path, 'protos')
-        self.solver_path = os.path.join(self.protos_path, 'solver.prototxt')
-        self.model_path = os.path.join(self.protos_path, 'train_val.prototxt')
-        self.logs_path = os.path.join(self.path, 'logs')
-        self.scripts_path = os.path.join(self.path, 'scripts')
+    def get_history(self, value_name=None, start=0, stop=None):
+        if value_name is None:
+            names = self.history.names
+        else:
+            names = [value_name]
 
-        if self.replace_mode == 1 and os.path.exists(self.protos_path):
-            self.prepare_protos()
+        with self.state_lock:
+            return dict((name, self.history.get(name, start, stop))
+                        for name in names)
 
-        if self.replace_mode in [0, 1] and os.path.exists(self.path):
-            self.snapshots_path = self.get_snapshots_directory()
-            return
+    def get_metrics(self, names=None, start=0, stop=None):
+        return MetricsReader(self.metrics_path).read_all(names, start, stop)
 
-        for d in [self.protos_path, self.logs_path, self.scripts_path]:
-            clear_dir(d)
-
-        self.prepare_protos()
-        self.prepare_scripts()
-        
-        self.snapshots_path = self.get_snapshots_directory()
-        clear_dir(self.snapshots_path)
-
-    def get_snapshots_directory(self):
-        snapshot_prefix_match = re_snapshot_prefix.search(
-            file(self.solver_path, 'r').read())
-        return os.path.dirname(snapshot_prefix_match.group(1))
-        
-    def prepare_protos(self):
-        model_template = file(self.experiment['model']['template'], 'r').read()
-        solver_template = file(self.experiment['solver']['template'], 'r').read()
-
-        model_template = Template(model_template)
-        solver_template = Template(solver_template)
-
-        model_values = self.experiment['model']['values']
-        solver_values = self.experiment['solver']['values']
-
-        solver_values.update({
-            'net': self.model_path,
-            'root': self.root_path,
-            'path': self.experiment['path']
-        })
-        
-        file(self.model_path, 'w').write(model_template.substitute(model_values))
-        file(self.solver_path, 'w').write(solver_template.substitute(solver_values))  
+    def set_paths(self):
+        self.path = os.path.join(self.root_path, self.experiment['path'])
 
-    def prepare_scripts(self):
-        train_script = Template(
-            default_scripts.TRAIN_TEMPLATE).substitute({'solver_path': self.solver_path})
-        plot_script = Template(
-            default_scripts.PLOT_TEMPLATE).substitute({'logs_path': self.logs_path})
+        self.protos_path = os.path.join(self.path, 'protos')
+        self.model_path, self.solver_path = proto_paths(self.root_path,
+                                                        self.experiment)
+        self.logs_path = os.path.join(self.path, 'logs')
+        self.scripts_path = os.path.join(self.path, 'scripts')
+        self.log_path = os.path.join(self.logs_path, 'log.txt')
+        self.checkpoint_path = os.path.join(self.logs_path, 'parser_state.json')
 
-        file(os.path.join(self.scripts_path, 'train.sh'), 'w').write(train_script)
-        file(os.path.join(self.scripts_path, 'plot.sh'), 'w').write(plot_script)
+    def open_snapshot_index(self):
+        self.snapshots = SnapshotIndex(
+            os.path.join(self.logs_path, 'snapshots.json'),
+            self.experiment['snapshots'])
 
-        for name in ['train.sh', 'plot.sh']:
-            path = os.path.join(self.scripts_path, name)
-            os.chmod(path, 0744)
+    def prepare_directories(self):
+        self.set_paths()
+
+        self.snapshots_path, trash = materialize(self.root_path,
+                                                 self.experiment)
+        deleter.delete(trash)
+
+        self.open_snapshot_index()
+
+    def attach_training(self, process):
+        """
+        Follows a training process launched before a server restart instead
+        of launching one; `process` is what `find_training_process` found.
+        """
+        self.set_paths()
+        self.snapshots_path = get_snapshots_directory(self.solver_path)
+        self.open_snapshot_index()
+        self.training_process = AttachedProcess(process['pid'],
+                                                process['pgid'])
+        self.state['pgid'].value = process['pgid']
 
     def run_training(self):
-        self.log_path = os.path.join(self.logs_path, 'log.txt')
         binary_path = os.path.join(self.caffe_root, 'build/tools/caffe')
 
-        # Check if there are any available snapshots and pick the
-        # latest one for training continuation
-        latest_snapshot = get_latest(self.snapshots_path, '*solverstate')
+        # Pick the latest snapshot for training continuation. The
+        # directory only needs to be scanned if the index does not know it,
+        # e.g. for experiments started before it existed.
+        latest_snapshot = self.snapshots.latest_solverstate()
+        if latest_snapshot is None:
+            latest_snapshot = get_latest(self.snapshots_path, '*solverstate')
+            if latest_snapshot:
+                latest_snapshot = os.path.join(self.snapshots_path,
+                                               latest_snapshot)
+        # A branch starts off where its trunk stopped.
+        if not latest_snapshot and 'warm_start' in self.experiment:
+            latest_snapshot = warm_start_snapshot(self.root_path,
+                                                  self.experiment)
+
+        # Devices are numbered from zero within the visible ones. Without a
+        # device list, srun makes as many visible as the experiment asks for.
+        if self.devices:
+            num_devices = len(self.devices)
+        else:
+            num_devices = max(int(math.ceil(self.experiment['gpus'])), 1)
+        if num_devices > 1 or self.devices:
+            gpu_ids = ','.join(str(i) for i in xrange(num_devices))
+        else:
+            gpu_ids = GPU_ID
 
         if self.custom_command:
-            training_string = 'srun --gres=gpu:1 {} 2>> {}'.format(
-                self.custom_command, self.log_path)
+            training_string = 'srun --gres=gpu:{} {} 2>> {}'.format(
+                num_devices, self.custom_command, self.log_path)
         elif latest_snapshot:
-            latest_snapshot = os.path.join(self.snapshots_path, latest_snapshot)
-
             training_string = (
-                'srun --gres=gpu:1 '
+                'srun --gres=gpu:{} '
                 '{} train '
                 '--solver={} '
                 '--snapshot={} '
                 '--gpu={} 2>> {}').format(
-                    binary_path, self.solver_path, latest_snapshot, GPU_ID, 
-                    self.log_path)
+                    num_devices, binary_path, self.solver_path,
+                    latest_snapshot, gpu_ids, self.log_path)
         else:
             if self.experiment['weights']:
                 weights_string = '--weights=' + self.experiment['weights']
@@ -174,77 +453,281 @@ class Worker(mp.Process):
                 weights_string = ''
                 
             training_string = (
-                'srun --gres=gpu:1 '
+                'srun --gres=gpu:{} '
                 '{} train '
                 '--solver={} {} '
                 '--gpu={} 2>> {}').format(
-                    binary_path, self.solver_path, weights_string, GPU_ID, 
-                    self.log_path)
+                    num_devices, binary_path, self.solver_path,
+                    weights_string, gpu_ids, self.log_path)
 
         file(os.path.join(self.path, 'training_string.txt'), 'w').write(training_string)
 
+        env = None
+        if self.devices:
+            env = dict(os.environ)
+            env['CUDA_VISIBLE_DEVICES'] = ','.join(str(d) for d in self.devices)
+
         self.training_process = subprocess.Popen(training_string, 
-            stdin=subprocess.PIPE, shell=True, preexec_fn=os.setsid)
+            stdin=subprocess.PIPE, shell=True, preexec_fn=os.setsid, env=env)
+
+        pid = self.training_process.pid
+        self.state['pgid'].value = pid
+        save_json(process_info_path(self.root_path, self.experiment), {
+            'pid': pid,
+            'pgid': pid,
+            'start_time': process_start_time(pid)
+        })
+
+    def stop_training(self, grace=KILL_GRACE, live=None):
+        """
+        Sends the training process group SIGTERM, and SIGKILL if it is still
+        there `grace` seconds later. It does not block: call it until it
+        returns True, which it does once no process of the group is left
+        and so its devices are free. `live` is passed on to
+        `process_group_running`.
+        """
+        # Reaps the leader if it is our child.
+        self.training_process.poll()
+        pgid = self.state['pgid'].value
+        if pgid <= 0 or not process_group_running(pgid, live):
+            return True
+
+        if self.kill_deadline is None:
+            self.kill_deadline = time.time() + grace
+            signal_group(pgid, signal.SIGTERM)
+            # A paused group would not see SIGTERM until it continues.
+            signal_group(pgid, signal.SIGCONT)
+        elif time.time() >= self.kill_deadline:
+            print('[!] %s did not stop in %g seconds, killing it.' % (
+                self.experiment['path'], grace))
+            signal_group(pgid, signal.SIGKILL)
+            self.kill_deadline = float('inf')
+        return False
+
+    def open_log(self):
+        """
+        Opens the log for parsing. Returns False if it does not exist yet.
+        """
+        try:
+            self.log_file = open(self.log_path, 'rb')
+        except IOError:
+            return False
+
+        self.parser = make_parser(self.experiment['parser'],
+                                  self.experiment['watch'])
+        self.metrics_writer = MetricsWriter(self.metrics_path)
+
+        offset = self.load_checkpoint()
+        self.reader = ChunkedLogReader(self.log_file, LOG_CHUNK_SIZE, offset)
+        self.checkpoint_time = time.time()
+        return True
+
+    def close_log(self):
+        if self.log_file is None:
+            return
+
+        self.save_checkpoint()
+        self.metrics_writer.close()
+        self.log_file.close()
+        self.log_file = None
+
+    def ingest(self):
+        """
+        Parses the next chunk of the log. Returns False if there was nothing
+        new to parse.
+        """
+        lines = self.reader.read_lines()
+        if len(lines) == 0:
+            return False
+
+        if self.counters is not None:
+            start = time.time()
+            self.parser.feed(lines)
+            stats.record_batch(self.counters, len(lines), time.time() - start)
+        else:
+            self.parser.feed(lines)
+        outputs = self.parser.pop_outputs()
+        self.metrics_writer.append(outputs)
+        deleter.delete(self.snapshots.update(self.parser.pop_snapshots(),
+                                             outputs))
+
+        if time.time() - self.checkpoint_time > CHECKPOINT_INTERVAL:
+            self.save_checkpoint()
+            self.checkpoint_time = time.time()
+
+        return True
+
+    def publish_state(self):
+        parser = self.parser
+        state = self.state
+        lag = self.reader.lag()
+        with self.state_lock:
+            updates = parser.pop_updates()
+            # Watched values only change along with an update.
+            if (not updates and state['iter'].value == parser.iteration and
+                    state['max_iter'].value == parser.max_iteration and
+                    state['log_lag'].value == lag):
+                return
+
+            state['iter'].value = parser.iteration
+            state['max_iter'].value = parser.max_iteration
+            state['watched_values'][:] = parser.watched_values[:]
+            state['log_lag'].value = lag
+            for update in updates:
+                self.history.append(*update)
+            state['version'].value += 1
+
+    def load_checkpoint(self):
+        """
+        Restores the parser from the last checkpoint and returns the log
+        offset to continue from. The checkpoint is ignored if the log has
+        been replaced or truncated since. The metrics store is rolled back
+        to the checkpoint as well, so that no record gets written twice.
+        """
+        checkpoint = load_json(self.checkpoint_path)
+
+        if checkpoint is not None:
+            st = os.fstat(self.log_file.fileno())
+            if (checkpoint['inode'] != st.st_ino or
+                    checkpoint['offset'] > st.st_size or
+                    'metrics' not in checkpoint):
+                checkpoint = None
+
+        if checkpoint is None:
+            self.metrics_writer.truncate({})
+            return 0
+
+        self.parser.restore_checkpoint(checkpoint['parser'])
+        self.metrics_writer.truncate(checkpoint['metrics'])
+        return checkpoint['offset']
+
+    def save_checkpoint(self):
+        # The offset has to sit on a line boundary.
+        if self.reader.discarding:
+            return
+
+        save_json(self.checkpoint_path, {
+            'inode': os.fstat(self.log_file.fileno()).st_ino,
+            'offset': self.reader.offset,
+            'parser': self.parser.get_checkpoint(),
+            'metrics': self.metrics_writer.counts()
+        })
+
+
+class Worker(ExperimentRunner, mp.Process):
+    def __init__(self, root_path, experiment, devices=None, done_queue=None,
+                 slot=None, attach=None):
+        """
+        If `done_queue` is given, the worker puts its `slot` into it once it
+        is done, so that the server can hand its devices over. If `attach`
+        is given, the worker follows that already running training process
+        (see `attach_training`) instead of launching one.
+        """
+        mp.Process.__init__(self)
+        ExperimentRunner.__init__(self, root_path, experiment, devices)
+
+        self.control_cond = mp.Condition()
+        self.is_terminated = mp.Value('i', 0)
+        self.kill_grace = mp.Value('d', KILL_GRACE)
+        self.is_listening = mp.Value('i', 0)
+
+        self.done_queue = done_queue
+        self.slot = slot
+        self.attach = attach
+        self.server_pid = os.getpid()
+
+    def run(self):
+        try:
+            if self.attach is not None:
+                self.set_status(1)
+                self.attach_training(self.attach)
+            else:
+                self.prepare_directories()
+
+                if self.no_run:
+                    return
+
+                self.set_status(1)
+                self.run_training()
+
+            self.main_loop()
+
+            self.set_status(2)
+        finally:
+            # The devices are not needed for deleting old snapshots.
+            if self.done_queue is not None:
+                self.done_queue.put(self.slot)
+            # Nothing deletes in the background once the process is gone.
+            deleter.wait()
+
+    def shutdown(self, grace=None):
+        """
+        Stops the experiment; its training process gets `grace` seconds
+        after SIGTERM before SIGKILL (see `stop_training`).
+        """
+        with self.control_cond:
+            if grace is not None:
+                self.kill_grace.value = grace
+            self.is_terminated.value = 1
+            self.control_cond.notify()
+
+            # An event-driven worker sleeps outside of `control_cond`, so
+            # it has to be woken up explicitly.
+            if self.is_listening.value:
+                try:
+                    os.kill(self.pid, signal.SIGUSR1)
+                except OSError:
+                    pass
 
     def main_loop(self):
+        watcher = make_log_watcher(
+            self.experiment['tail'], self.log_path, self.control_cond)
+
+        with self.control_cond:
+            self.is_listening.value = int(watcher.wakes_on_signal)
+
+        try:
+            self.follow_log(watcher)
+        finally:
+            with self.control_cond:
+                self.is_listening.value = 0
+            watcher.close()
+            self.close_log()
+
+    def check_terminated(self):
+        if os.getppid() != self.server_pid:
+            # The server is gone. The training process is left running for
+            # the next server to reattach to.
+            return True
+
+        with self.control_cond:
+            if not self.is_terminated.value:
+                return False
+
+        # The devices are handed over once the worker is done, so it only is
+        # once the training process is gone.
+        while not self.stop_training(self.kill_grace.value):
+            time.sleep(STOP_POLL_INTERVAL)
+        return True
+
+    def follow_log(self, watcher):
         # Wait till log appears.
+        while not self.open_log():
+            if self.check_terminated():
+                return
+            watcher.wait()
+
         while True:
-            try:
-                with open(self.log_path, 'r') as _:
-                    break
-            except IOError:
-                time.sleep(1)
-
-        iteration = 0.0
-        max_iteration = 0.0
-        watched_values = [0.0] * len(self.state['watched_values'])
-
-        with open(self.log_path, 'r') as log_file:
-            while True:
-                with self.state_lock:
-                    self.state['iter'].value = iteration
-                    self.state['max_iter'].value = max_iteration
-                    self.state['watched_values'][:] = watched_values[:]
-                    
-                with self.control_cond:
-                    if self.is_terminated.value:
-                        os.killpg(self.training_process.pid, signal.SIGTERM)
-                        return
-
-                where = log_file.tell()
-                lines = log_file.readlines()
-                if len(lines) == 0:
-                    log_file.seek(where)
-
-                    with self.control_cond:
-                        self.control_cond.wait(5)
-                else:
-                    # We got non-empty log data. It's time to parse it.
-                    for line in lines:
-                        iteration_match = re_iteration.search(line)
-                        if iteration_match:
-                            iteration = float(iteration_match.group(1))
-
-                        max_iter_match = re_max_iter.search(line)
-                        if max_iter_match:
-                            max_iteration = float(max_iter_match.group(1))
-
-                        top_output_match = re_top_output.search(line)
-                        if top_output_match:
-                            value_name = top_output_match.group(1)
-                            value = float(top_output_match.group(2))
-                            if value_name in self.watched_dict.keys():
-                                watched_values[self.watched_dict[value_name]] = value
-
-                        output_match = re_output.search(line)
-                        if output_match:
-                            value_name = output_match.group(1).lower()
-                            value_name += '_' + output_match.group(2)
-                            value = float(output_match.group(3))
-                            if value_name in self.watched_dict.keys():
-                                watched_values[self.watched_dict[value_name]] = value
-
-                self.training_process.poll()
-                if self.training_process.returncode is not None:
+            self.publish_state()
+
+            if self.check_terminated():
+                return
+
+            if not self.ingest():
+                # The log is drained, so we are done as soon as the
+                # training process is.
+                if self.training_process.poll() is not None:
                     return
-    
\ No newline at end of file
+
+                watcher.wait()
+